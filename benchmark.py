@@ -0,0 +1,180 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from model import MultiHeadAttentionBlock, LayerNormalisation, FeedForwardBlock, EncoderBlock, DecoderBlock, LengthMask, build_transformer
+from train import greedy_decode, compute_loss
+from config import get_config
+
+# Micro-benchmarks of the model components, a training step and greedy_decode on random weights and inputs.
+# Every benchmark runs for each combination of the swept batch sizes, sequence lengths, d_model and thread
+# counts, results are written as JSON and compared against a baseline file:
+#   python benchmark.py --out bench.json --baseline bench_baseline.json
+#   python benchmark.py --out bench_baseline.json                 (record a new baseline)
+
+class SyntheticTokenizer:
+    # greedy_decode only needs the ids of [SOS] / [EOS], an unreachable [EOS] makes it run for max_len steps
+    def token_to_id(self, token):
+        return {'[SOS]': 2, '[EOS]': -1, '[PAD]': 1}[token]
+
+def attention_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    block = MultiHeadAttentionBlock(d_model, h, 0.0).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
+    mask = LengthMask(torch.full((batch_size,), seq_len))
+    return lambda: block(x, x, x, mask)
+
+def layer_norm_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    block = LayerNormalisation(d_model).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
+    return lambda: block(x)
+
+def feed_forward_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    block = FeedForwardBlock(d_model, d_ff, 0.0).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
+    return lambda: block(x)
+
+def encoder_block_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    block = EncoderBlock(d_model, MultiHeadAttentionBlock(d_model, h, 0.0), FeedForwardBlock(d_model, d_ff, 0.0), 0.0).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
+    mask = LengthMask(torch.full((batch_size,), seq_len))
+    return lambda: block(x, mask)
+
+def decoder_block_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    block = DecoderBlock(d_model, MultiHeadAttentionBlock(d_model, h, 0.0), MultiHeadAttentionBlock(d_model, h, 0.0), FeedForwardBlock(d_model, d_ff, 0.0), 0.0).eval()
+    x = torch.randn(batch_size, seq_len, d_model)
+    lengths = torch.full((batch_size,), seq_len)
+    return lambda: block(x, x, LengthMask(lengths), LengthMask(lengths, causal=True))
+
+def train_step_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    model = build_transformer(vocab_size, vocab_size, seq_len, seq_len, d_model=d_model, N=layers, h=h, d_ff=d_ff).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4, eps=1e-9)
+    loss_fn = nn.CrossEntropyLoss(ignore_index=1, label_smoothing=0.1)
+    lengths = torch.full((batch_size,), seq_len)
+    batch = {
+        'encoder_input': torch.randint(4, vocab_size, (batch_size, seq_len)),
+        'decoder_input': torch.randint(4, vocab_size, (batch_size, seq_len)),
+        'encoder_mask': LengthMask(lengths),
+        'decoder_mask': LengthMask(lengths, causal=True),
+        'label': torch.randint(4, vocab_size, (batch_size, seq_len)),
+    }
+    config = dict(get_config(), bf16=False)
+
+    def step():
+        loss = compute_loss(config, model, batch, torch.device('cpu'), loss_fn, 1, vocab_size)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    return step
+
+def greedy_decode_case(batch_size, seq_len, d_model, h, d_ff, vocab_size, layers):
+    # greedy_decode translates one sentence, the batch size is the number of sentences
+    model = build_transformer(vocab_size, vocab_size, seq_len, seq_len, d_model=d_model, N=layers, h=h, d_ff=d_ff).eval()
+    tokenizer = SyntheticTokenizer()
+    sources = torch.randint(4, vocab_size, (batch_size, 1, seq_len))
+    mask = LengthMask(torch.full((1,), seq_len))
+
+    @torch.inference_mode()
+    def decode():
+        for source in sources:
+            greedy_decode(model, source, mask, tokenizer, tokenizer, seq_len, torch.device('cpu'))
+    return decode
+
+BENCHMARKS = {
+    'attention': attention_case,
+    'layer_norm': layer_norm_case,
+    'feed_forward': feed_forward_case,
+    'encoder_block': encoder_block_case,
+    'decoder_block': decoder_block_case,
+    'train_step': train_step_case,
+    'greedy_decode': greedy_decode_case,
+}
+
+def time_it(fn, warmup: int, repeats: int):
+    # median wall time in ms, the median is less sensitive to the odd slow run than the mean
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(1000 * (time.perf_counter() - start))
+    return statistics.median(timings), min(timings)
+
+def result_key(result):
+    return (result['name'], result['batch_size'], result['seq_len'], result['d_model'], result['threads'])
+
+def run_benchmarks(args):
+    results = []
+    for name in args.benchmarks:
+        for batch_size, seq_len, d_model, threads in itertools.product(args.batch_sizes, args.seq_lens, args.d_models, args.threads):
+            torch.manual_seed(0)
+            torch.set_num_threads(threads)
+            fn = BENCHMARKS[name](batch_size, seq_len, d_model, args.heads, 4 * d_model, args.vocab_size, args.layers)
+            repeats = max(1, args.repeats // 5) if name in ('train_step', 'greedy_decode') else args.repeats
+            with torch.no_grad() if name != 'train_step' else torch.enable_grad():
+                median_ms, min_ms = time_it(fn, args.warmup, repeats)
+            result = {
+                'name': name, 'batch_size': batch_size, 'seq_len': seq_len, 'd_model': d_model, 'threads': threads,
+                'median_ms': round(median_ms, 4), 'min_ms': round(min_ms, 4),
+                'tokens_per_sec': round(batch_size * seq_len / (median_ms / 1000), 1),
+            }
+            results.append(result)
+            print(f"{name:14s} batch {batch_size:4d} seq_len {seq_len:4d} d_model {d_model:4d} threads {threads:3d}: {median_ms:9.3f} ms ({result['tokens_per_sec']:.0f} tokens/s)")
+    return results
+
+def compare(results, baseline, threshold: float):
+    # regressions are cases more than threshold (relative) slower than in the baseline, new cases are skipped
+    previous = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        change = result['median_ms'] / old['median_ms'] - 1
+        if change > threshold:
+            regressions.append((result, old, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the transformer components")
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--seq_lens', nargs='+', type=int, default=[32, 128])
+    parser.add_argument('--d_models', nargs='+', type=int, default=[256, 512])
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--layers', type=int, default=2, help="encoder / decoder layers of the train_step and greedy_decode models")
+    parser.add_argument('--vocab_size', type=int, default=16000)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--out', type=str, default='bench.json')
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative slowdown against the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    Path(args.out).write_text(json.dumps({
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }, indent=2))
+    print(f"Wrote {len(results)} results to {args.out}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.threshold)
+        for result, old, change in regressions:
+            print(f"REGRESSION {result['name']} batch {result['batch_size']} seq_len {result['seq_len']} d_model {result['d_model']} threads {result['threads']}: {old['median_ms']:.3f} -> {result['median_ms']:.3f} ms (+{change:.1%})")
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%} against {args.baseline}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,128 @@
+import os
+import re
+import threading
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Copy every tensor of a (nested) state dict to CPU memory, so that training can keep
+# updating the live tensors while the copy is being written
+def snapshot_state(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot_state(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(value) for value in state)
+    return state
+
+# Write to a hidden temporary file next to path, then rename: a checkpoint file is either complete or absent
+def atomic_save(state, path):
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Epoch number in a weights file name (tmodel_07.pt -> 7), None for other names
+def checkpoint_epoch(path, basename):
+    match = re.fullmatch(re.escape(basename) + r'(\d+)\.pt', Path(path).name)
+    return int(match.group(1)) if match else None
+
+# Checkpoints in folder ordered by epoch (numerically, tmodel_100.pt comes after tmodel_99.pt)
+def list_checkpoints(folder, basename):
+    files = [(checkpoint_epoch(path, basename), path) for path in Path(folder).glob(f"{basename}*.pt")]
+    return [path for epoch, path in sorted(f for f in files if f[0] is not None)]
+
+def load_checkpoint(path, map_location='cpu'):
+    # memory-mapped: the tensors are only read from disk when they are used
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 or a checkpoint in the legacy (non zip) format
+        return torch.load(path, map_location=map_location)
+
+def _pack_state(parts):
+    # Adam state of w_q, w_k and w_v -> state of the packed w_qkv (the step count is shared)
+    return {key: torch.cat([part[key] for part in parts]) if isinstance(value, torch.Tensor) and value.dim() > 0 else value for key, value in parts[0].items()}
+
+def _unpack_state(packed, index):
+    # Adam state of the packed w_qkv -> state of w_q (index 0), w_k (1) or w_v (2)
+    return {key: value.chunk(3)[index].clone() if isinstance(value, torch.Tensor) and value.dim() > 0 else value for key, value in packed.items()}
+
+def remap_optimizer_state(optimizer_state, checkpoint_model_state, model):
+    # Optimizer state of a checkpoint saved with the other attention layout (separate w_q / w_k / w_v or the packed
+    # w_qkv of FusedMultiHeadAttentionBlock), renumbered for the parameters of model. The optimizer state refers to
+    # the parameters by position, their names come from the checkpoint's model state (parameters in the same order,
+    # without the buffers). None if the state can't be mapped
+    if len(optimizer_state['param_groups']) != 1:
+        return None
+    buffers = {name for name, _ in model.named_buffers()}
+    old_names = [name for name in checkpoint_model_state if name not in buffers]
+    old_ids = optimizer_state['param_groups'][0]['params']
+    if len(old_names) != len(old_ids):
+        return None
+    old = {name: optimizer_state['state'].get(i) for name, i in zip(old_names, old_ids)}
+
+    names = [name for name, _ in model.named_parameters()]
+    state = {}
+    for i, name in enumerate(names):
+        prefix, _, kind = name.rpartition('.') # kind: weight / bias
+        block, _, layer = prefix.rpartition('.')
+        if name in old:
+            param_state = old[name]
+        elif layer == 'w_qkv':
+            keys = [f"{block}.{key}.{kind}" for key in ('w_q', 'w_k', 'w_v')]
+            if not all(key in old for key in keys):
+                return None
+            parts = [old[key] for key in keys]
+            param_state = _pack_state(parts) if all(part is not None for part in parts) else None
+        elif layer in ('w_q', 'w_k', 'w_v'):
+            if f"{block}.w_qkv.{kind}" not in old:
+                return None
+            packed = old[f"{block}.w_qkv.{kind}"]
+            param_state = _unpack_state(packed, ('w_q', 'w_k', 'w_v').index(layer)) if packed is not None else None
+        else:
+            return None
+        if param_state is not None:
+            state[i] = param_state
+    return {'state': state, 'param_groups': [dict(optimizer_state['param_groups'][0], params=list(range(len(names))))]}
+
+class AsyncCheckpointer:
+    # Saves checkpoints from a background thread: save() only takes a CPU snapshot of the state,
+    # the serialization, the atomic rename and the retention policy (keep_last newest checkpoints
+    # of folder, None keeps all) run while training continues
+
+    def __init__(self, folder, basename, keep_last=None) -> None:
+        self.folder = Path(folder)
+        self.basename = basename
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def save(self, state, path):
+        snapshot = snapshot_state(state)
+        # at most one checkpoint in flight, so snapshots don't pile up in memory
+        self.wait()
+        with self.lock:
+            self.pending = self.executor.submit(self._write, snapshot, path)
+
+    def _write(self, snapshot, path):
+        atomic_save(snapshot, path)
+        if self.keep_last:
+            for old_path in list_checkpoints(self.folder, self.basename)[:-self.keep_last]:
+                old_path.unlink(missing_ok=True)
+
+    def wait(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            # raises the exception of a failed write
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,33 +1,104 @@
 from pathlib import Path
 
+from checkpointing import list_checkpoints
+
 def get_config():
     return {
         "batch_size": 8,
+        "effective_batch_size": None,
+        "activation_checkpointing": False,
+        "max_tokens": None,
+        "pack_sequences": False,
+        "val_batch_size": 1,
+        "beam_size": 1,
         "num_epochs": 20,
+        "seed": 42,
+        "dist_backend": "gloo",
         "lr": 10**-4,
+        "loss_chunk_size": 1024,
         "seq_len": 350,
         "d_model": 512,
+        "N": 6,
+        "N_dec": None,
+        "h": 8,
+        "d_ff": 2048,
+        # 'math' | 'sdpa' | 'chunked', every backend keeps the attention softmax in fp32 when bf16 is set
+        # (sdpa falls back to the math path then: bf16 matmuls, fp32 softmax)
+        "attention_backend": "sdpa",
+        "fused": False,
+        "bf16": False,
         "datasource": 'opus_books',
         "lang_src": "en",
         "lang_tgt": "it",
         "model_folder": "weights",
         "model_basename": "tmodel_",
         "preload": "latest",
+        "keep_checkpoints": None,
         "tokenizer_file": "tokenizer_{0}.json",
-        "experiment_name": "runs/tmodel"
+        "token_cache_folder": "tokens",
+        "use_token_cache": True,
+        "num_workers": 2,
+        "persistent_workers": True,
+        "distilled_targets": None,
+        "distill_alpha": 0.5,
+        "distill_temperature": 2.0,
+        "sequence_distillation": False,
+        "experiment_name": "runs/tmodel",
+        "metrics_flush_every": 50,
+        "profile_steps": None,
+        "int8_inference": False,
+        "vocab_shortlist": False,
+        "shortlist_top_k": 50,
+        "shortlist_frequent": 1000,
+        "translation_cache_mb": 64,
+        "encoder_cache_mb": 0,
+        "export_batch_sizes": [1, 8, 32],
+        "export_src_lens": [32, 64, 128, 350],
+        "export_tgt_lens": [32, 64, 128],
+        "engine_replicas": 2,
+        "engine_threads": None,
+        "engine_max_batch_size": 32,
+        "serve_host": "127.0.0.1",
+        "serve_port": 8080,
+        "serve_max_batch_size": 32,
+        "serve_max_wait_ms": 10
     }
 
+# Student model trained by distill.py with the model of get_config() as the teacher:
+# same encoder depth, a single decoder layer and a narrower feed forward block
+def get_student_config():
+    return dict(get_config(),
+        N_dec=1,
+        d_ff=1024,
+        model_folder="weights_student",
+        model_basename="smodel_",
+        experiment_name="runs/smodel",
+    )
+
 def get_weights_file_path(config, epoch: str):
     model_folder = f"{config['datasource']}_{config['model_folder']}"
     model_filename = f"{config['model_basename']}{epoch}.pt"
     return str(Path('.') / model_folder / model_filename)
 
-# Find the latest weights file in the weights folder
+# Folder with the pre-tokenized dataset written by dataset.build_token_cache
+def get_token_cache_path(config):
+    cache_folder = f"{config['datasource']}_{config['token_cache_folder']}"
+    return str(Path('.') / cache_folder / f"{config['lang_src']}-{config['lang_tgt']}")
+
+# The int8 copy of a checkpoint (see quantize.py), kept in its own folder so that
+# latest_weights_file_path never picks it up
+def get_quantized_weights_file_path(config, weights_file):
+    model_folder = f"{config['datasource']}_{config['model_folder']}_int8"
+    return str(Path('.') / model_folder / Path(weights_file).name)
+
+# Lexical shortlist table of the output vocabulary (see shortlist.py), next to the token cache
+def get_shortlist_path(config):
+    return str(Path(get_token_cache_path(config)) / f"shortlist_k{config['shortlist_top_k']}_f{config['shortlist_frequent']}.pt")
+
+# Find the latest weights file in the weights folder (highest epoch number, not the last name in lexical order)
 def latest_weights_file_path(config):
     model_folder = f"{config['datasource']}_{config['model_folder']}"
-    model_filename = f"{config['model_basename']}*"
-    weights_files = list(Path(model_folder).glob(model_filename))
+    weights_files = list_checkpoints(model_folder, config['model_basename'])
     if len(weights_files) == 0:
         return None
-    weights_files.sort()
     return str(weights_files[-1])
\ No newline at end of file
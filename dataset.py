@@ -1,6 +1,13 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+import numpy as np
+import hashlib
+import json
+import random
+from pathlib import Path
+from torch.utils.data import Dataset, Sampler
+
+from model import LengthMask, SegmentMask
 
 class BilingualDataset(Dataset):
 
@@ -78,13 +85,305 @@ class BilingualDataset(Dataset):
         return {
             "encoder_input": encoder_input,  # (seq_len)
             "decoder_input": decoder_input,  # (seq_len)
-            "encoder_mask": (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(), # (1, 1, seq_len)
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)), # (1, seq_len) & (1, seq_len, seq_len),
+            "encoder_len": len(enc_input_tokens) + 2,  # number of non [PAD] tokens, see collate_batch for the masks
+            "decoder_len": len(dec_input_tokens) + 1,
             "label": label,  # (seq_len)
             "src_text": src_text,
             "tgt_text": tgt_text,
         }
 
+# Identifies the content of a token cache: the dataset version and both tokenizers
+def token_cache_key(ds, tokenizer_src, tokenizer_tgt):
+    h = hashlib.sha256()
+    h.update(str(getattr(ds, '_fingerprint', len(ds))).encode())
+    h.update(tokenizer_src.to_str().encode())
+    h.update(tokenizer_tgt.to_str().encode())
+    return h.hexdigest()[:16]
+
+# Tokenize every sentence pair once and store the token ids of each language as one flat array,
+# plus an offsets array: the ids of sentence i are tokens[offsets[i]:offsets[i + 1]].
+# encode_batch runs the tokenizer on all cores, the length statistics are collected in the same pass
+def build_token_cache(ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, cache_dir, batch_size: int = 2048):
+    ids = {'src': [], 'tgt': []}
+    for start in range(0, len(ds), batch_size):
+        pairs = ds[start:start + batch_size]['translation']
+        ids['src'].extend(e.ids for e in tokenizer_src.encode_batch([pair[src_lang] for pair in pairs]))
+        ids['tgt'].extend(e.ids for e in tokenizer_tgt.encode_batch([pair[tgt_lang] for pair in pairs]))
+    return write_token_cache(ids, cache_dir)
+
+# Write the token ids of every pair ({'src': [...], 'tgt': [...]}) in the token cache format
+def write_token_cache(ids, cache_dir):
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    meta = {'num_pairs': len(ids['src'])}
+    for prefix in ('src', 'tgt'):
+        lengths = np.fromiter((len(x) for x in ids[prefix]), dtype=np.int64, count=len(ids[prefix]))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        tokens = np.fromiter((t for x in ids[prefix] for t in x), dtype=np.int32, count=int(offsets[-1]))
+        np.save(cache_dir / f'{prefix}_tokens.npy', tokens)
+        np.save(cache_dir / f'{prefix}_offsets.npy', offsets)
+        meta[f'max_len_{prefix}'] = int(lengths.max()) if len(lengths) else 0
+    # written last, a cache without meta.json is incomplete
+    with open(cache_dir / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+# Length statistics of a complete token cache, None if it doesn't exist (yet)
+def load_token_cache_meta(cache_dir):
+    meta_path = Path(cache_dir) / 'meta.json'
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+class TokenizedBilingualDataset(Dataset):
+    # Same samples as BilingualDataset, but served from the token cache written by build_token_cache.
+    # The arrays are memory-mapped (copy-on-write) so DataLoader workers share the same pages
+    # and nothing is tokenized again during training
+
+    def __init__(self, cache_dir, tokenizer_tgt, seq_len, ds=None, src_lang=None, tgt_lang=None):
+        super().__init__()
+
+        self.seq_len = seq_len
+        # the raw dataset is only needed for the src_text / tgt_text fields (validation)
+        self.ds = ds
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+
+        cache_dir = Path(cache_dir)
+        self.src_tokens = np.load(cache_dir / 'src_tokens.npy', mmap_mode='c')
+        self.src_offsets = np.load(cache_dir / 'src_offsets.npy', mmap_mode='c')
+        self.tgt_tokens = np.load(cache_dir / 'tgt_tokens.npy', mmap_mode='c')
+        self.tgt_offsets = np.load(cache_dir / 'tgt_offsets.npy', mmap_mode='c')
+
+        self.sos_token = tokenizer_tgt.token_to_id("[SOS]")
+        self.eos_token = tokenizer_tgt.token_to_id("[EOS]")
+        self.pad_token = tokenizer_tgt.token_to_id("[PAD]")
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def lengths(self):
+        # padded-free length of every sample: <s> tokens </s> on the encoder side, <s> tokens on the decoder side
+        return np.maximum(np.diff(self.src_offsets) + 2, np.diff(self.tgt_offsets) + 1)
+
+    def src_ids(self, idx):
+        return torch.from_numpy(self.src_tokens[self.src_offsets[idx]:self.src_offsets[idx + 1]])
+
+    def tgt_ids(self, idx):
+        return torch.from_numpy(self.tgt_tokens[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]])
+
+    def __getitem__(self, idx):
+        # zero-copy int32 views into the memory-mapped arrays
+        enc_input_tokens = self.src_ids(idx)
+        dec_input_tokens = self.tgt_ids(idx)
+        enc_len = enc_input_tokens.size(0)
+        dec_len = dec_input_tokens.size(0)
+
+        # Make sure the number of padding tokens is not negative. If it is, the sentence is too long
+        if enc_len + 2 > self.seq_len or dec_len + 1 > self.seq_len:
+            raise ValueError("Sentence is too long")
+
+        # one allocation per tensor: fill with padding, then copy sos / tokens / eos in place
+        encoder_input = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        encoder_input[0] = self.sos_token
+        encoder_input[1:enc_len + 1] = enc_input_tokens
+        encoder_input[enc_len + 1] = self.eos_token
+
+        decoder_input = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        decoder_input[0] = self.sos_token
+        decoder_input[1:dec_len + 1] = dec_input_tokens
+
+        label = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        label[:dec_len] = dec_input_tokens
+        label[dec_len] = self.eos_token
+
+        item = {
+            "encoder_input": encoder_input,  # (seq_len)
+            "decoder_input": decoder_input,  # (seq_len)
+            "encoder_len": enc_len + 2,  # number of non [PAD] tokens, see collate_batch for the masks
+            "decoder_len": dec_len + 1,
+            "label": label,  # (seq_len)
+        }
+        if self.ds is not None:
+            item["src_text"] = self.ds[idx]['translation'][self.src_lang]
+            item["tgt_text"] = self.ds[idx]['translation'][self.tgt_lang]
+        return item
+
+class PackedBilingualDataset(Dataset):
+    # Training rows holding several sentence pairs each, packed back to back up to seq_len tokens.
+    # Every pair keeps its own <s> / </s>, gets its own segment id (1, 2, ...) and its positions
+    # restart at 0, collate_batch turns the segment ids into block diagonal masks (SegmentMask)
+
+    def __init__(self, token_ds: TokenizedBilingualDataset, indices, seq_len: int, shuffle: bool = True, seed: int = 0) -> None:
+        super().__init__()
+        self.token_ds = token_ds
+        self.seq_len = seq_len
+        self.pad_token = token_ds.pad_token
+
+        # seeded so that every rank of a distributed run packs the same rows
+        indices = list(indices)
+        if shuffle:
+            random.Random(seed).shuffle(indices)
+        src_lengths = np.diff(token_ds.src_offsets) + 2 # <s> tokens </s>
+        tgt_lengths = np.diff(token_ds.tgt_offsets) + 1 # <s> tokens / tokens </s>
+
+        # next fit: keep adding pairs to the current row while both sides still fit in seq_len
+        self.rows = []
+        self.row_lengths = []
+        row, src_used, tgt_used = [], 0, 0
+        for idx in indices:
+            src_len, tgt_len = int(src_lengths[idx]), int(tgt_lengths[idx])
+            if src_len > seq_len or tgt_len > seq_len:
+                raise ValueError("Sentence is too long")
+            if row and (src_used + src_len > seq_len or tgt_used + tgt_len > seq_len):
+                self.rows.append(row)
+                self.row_lengths.append(max(src_used, tgt_used))
+                row, src_used, tgt_used = [], 0, 0
+            row.append(idx)
+            src_used += src_len
+            tgt_used += tgt_len
+        if row:
+            self.rows.append(row)
+            self.row_lengths.append(max(src_used, tgt_used))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def lengths(self):
+        return self.row_lengths
+
+    def __getitem__(self, idx):
+        encoder_input = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        decoder_input = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        label = torch.full((self.seq_len,), self.pad_token, dtype=torch.int64)
+        encoder_segments = torch.zeros(self.seq_len, dtype=torch.int64)
+        decoder_segments = torch.zeros(self.seq_len, dtype=torch.int64)
+        encoder_positions = torch.zeros(self.seq_len, dtype=torch.int64)
+        decoder_positions = torch.zeros(self.seq_len, dtype=torch.int64)
+
+        enc_pos, dec_pos = 0, 0
+        for segment, pair_idx in enumerate(self.rows[idx], start=1):
+            src_ids = self.token_ds.src_ids(pair_idx)
+            tgt_ids = self.token_ds.tgt_ids(pair_idx)
+            src_len, tgt_len = src_ids.size(0) + 2, tgt_ids.size(0) + 1
+
+            # <s> tokens </s>
+            encoder_input[enc_pos] = self.token_ds.sos_token
+            encoder_input[enc_pos + 1:enc_pos + src_len - 1] = src_ids
+            encoder_input[enc_pos + src_len - 1] = self.token_ds.eos_token
+            encoder_segments[enc_pos:enc_pos + src_len] = segment
+            encoder_positions[enc_pos:enc_pos + src_len] = torch.arange(src_len)
+
+            # <s> tokens on the input, tokens </s> on the label
+            decoder_input[dec_pos] = self.token_ds.sos_token
+            decoder_input[dec_pos + 1:dec_pos + tgt_len] = tgt_ids
+            label[dec_pos:dec_pos + tgt_len - 1] = tgt_ids
+            label[dec_pos + tgt_len - 1] = self.token_ds.eos_token
+            decoder_segments[dec_pos:dec_pos + tgt_len] = segment
+            decoder_positions[dec_pos:dec_pos + tgt_len] = torch.arange(tgt_len)
+
+            enc_pos += src_len
+            dec_pos += tgt_len
+
+        return {
+            "encoder_input": encoder_input,  # (seq_len)
+            "decoder_input": decoder_input,  # (seq_len)
+            "label": label,  # (seq_len)
+            "encoder_segments": encoder_segments,  # (seq_len) 0 for [PAD]
+            "decoder_segments": decoder_segments,  # (seq_len)
+            "encoder_positions": encoder_positions,  # (seq_len) restart at 0 for every pair
+            "decoder_positions": decoder_positions,  # (seq_len)
+            "encoder_len": enc_pos,
+            "decoder_len": dec_pos,
+        }
+
+# Stack the samples of a batch and cut away the padding columns that no sample in the batch uses,
+# so every batch is only as long as its longest sentence instead of seq_len.
+# The masks are only built here, as LengthMask (lengths + a causal mask shared by all batches of the same shape)
+def collate_batch(batch, pad_token):
+    out = {}
+    for key in batch[0]:
+        if isinstance(batch[0][key], torch.Tensor):
+            out[key] = torch.stack([item[key] for item in batch])
+        elif isinstance(batch[0][key], int):
+            out[key] = torch.tensor([item[key] for item in batch], dtype=torch.int64)
+        else:
+            out[key] = [item[key] for item in batch]
+
+    enc_len = int(out['encoder_len'].max())
+    dec_len = int(out['decoder_len'].max())
+    out['encoder_input'] = out['encoder_input'][:, :enc_len].contiguous() # (batch, enc_len)
+    out['decoder_input'] = out['decoder_input'][:, :dec_len].contiguous() # (batch, dec_len)
+    out['label'] = out['label'][:, :dec_len].contiguous() # (batch, dec_len)
+    if 'encoder_segments' in out:
+        # packed rows (PackedBilingualDataset): block diagonal masks so the pairs of a row can't see each other
+        for key in ('encoder_segments', 'encoder_positions'):
+            out[key] = out[key][:, :enc_len].contiguous()
+        for key in ('decoder_segments', 'decoder_positions'):
+            out[key] = out[key][:, :dec_len].contiguous()
+        out['encoder_mask'] = SegmentMask(out['encoder_segments'], out['encoder_segments'])
+        out['decoder_mask'] = SegmentMask(out['decoder_segments'], out['decoder_segments'], causal=True)
+        out['cross_mask'] = SegmentMask(out['decoder_segments'], out['encoder_segments'])
+        return out
+
+    out['encoder_mask'] = LengthMask(out['encoder_len']) # hide only [PAD] tokens
+    out['decoder_mask'] = LengthMask(out['decoder_len'], causal=True) # hide [PAD] and subsequent tokens
+    return out
+
+class BucketBatchSampler(Sampler):
+    # Groups sentences of similar length into batches of at most max_tokens (padded) tokens.
+    # The indices are shuffled, cut into buckets of bucket_size, each bucket is sorted by length
+    # and split into batches, then the order of the batches is shuffled again.
+    # With num_replicas > 1 (distributed training) every rank builds the same batches from the same
+    # seed and epoch, and takes every num_replicas-th one
+
+    def __init__(self, lengths, max_tokens: int, bucket_size: int = 4096, shuffle: bool = True, num_replicas: int = 1, rank: int = 0, seed: int = 0) -> None:
+        self.lengths = [int(x) for x in lengths]
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self._make_batches()
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            batch = []
+            for idx in bucket:
+                # the bucket is sorted, so the newest sample is always the longest of the batch
+                if batch and self.lengths[idx] * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        # the same number of batches on every rank
+        num_batches = len(batches) // self.num_replicas
+        return batches[self.rank:num_batches * self.num_replicas:self.num_replicas]
+
+    def __iter__(self):
+        # the batches only change in set_epoch, so len() stays the length of the running epoch
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
 # prevent input from watching input words
 def causal_mask(size):
     mask = torch.triu(torch.ones((1, size, size)), diagonal=1).type(torch.int)
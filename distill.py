@@ -0,0 +1,86 @@
+import argparse
+import torch
+from pathlib import Path
+from tqdm import tqdm
+from datasets import load_dataset
+
+import torchmetrics
+
+from dataset import TokenizedBilingualDataset, write_token_cache, load_token_cache_meta
+from train import get_or_build_tokenizer, get_or_build_token_cache, split_ds, train_model
+from translate import Translator, uncached_config, validation_sources
+from quantize import timed_translate
+from config import get_config, get_student_config
+
+# Knowledge distillation of the trained model of get_config() (the teacher) into the smaller model of
+# get_student_config() (the student):
+#   word level:     the student learns from the teacher's output distribution on every training batch
+#                   next to the reference labels (distill_alpha, distill_temperature)
+#   sequence level: the training targets are replaced by the teacher's translations of the training
+#                   sources first (sequence_distillation), validation keeps the references
+#   python distill.py train
+#   python distill.py report
+
+def build_distilled_targets(teacher: Translator, config, batch_size: int = 64):
+    # Token cache with the teacher's translation as the target of every training pair, next to the token cache
+    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+    train_ds_raw, _ = split_ds(config, ds_raw)
+    cache_dir, _ = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt)
+    distilled_dir = Path(cache_dir).with_name(f"{Path(cache_dir).name}_distilled_{Path(teacher.weights_file).stem}")
+    if load_token_cache_meta(distilled_dir) is not None:
+        return str(distilled_dir)
+
+    token_ds = TokenizedBilingualDataset(cache_dir, tokenizer_tgt, config['seq_len'])
+    ids = {
+        'src': [token_ds.src_ids(i).tolist() for i in range(len(token_ds))],
+        'tgt': [token_ds.tgt_ids(i).tolist() for i in range(len(token_ds))],
+    }
+    # sentences of similar length in the same batch, so little time goes into padding
+    indices = sorted(train_ds_raw.indices, key=lambda i: len(ids['src'][i]))
+    for start in tqdm(range(0, len(indices), batch_size), desc="Translating the training set with the teacher"):
+        batch = indices[start:start + batch_size]
+        batch_ids = [tuple(ids['src'][i][:config['seq_len'] - 2]) for i in batch]
+        source, source_mask = teacher.encode_sources(batch_ids)
+        with torch.inference_mode(), torch.autocast(device_type=teacher.device.type, dtype=torch.bfloat16, enabled=teacher.config['bf16'] and not teacher.quantized):
+            model_out = teacher.decode_batch(source, source_mask, teacher.encode_batch(batch_ids, source, source_mask))
+        for i, row in zip(batch, model_out.cpu().tolist()):
+            # drop <s>, keep everything before </s>
+            row = row[1:]
+            ids['tgt'][i] = row[:row.index(teacher.eos_idx)] if teacher.eos_idx in row else row
+    write_token_cache(ids, distilled_dir)
+    return str(distilled_dir)
+
+def distill(config, teacher_config):
+    teacher = Translator(uncached_config(teacher_config))
+    print(f"Teacher {teacher.weights_file}: {sum(p.numel() for p in teacher.model.parameters()) / 1e6:.1f}M parameters")
+    if config['sequence_distillation']:
+        config = dict(config, distilled_targets=build_distilled_targets(teacher, teacher_config))
+    # distill_alpha 0 trains on the (distilled) targets alone
+    train_model(config, teacher.model if config['distill_alpha'] > 0 else None)
+
+def report(config, teacher_config, num_sentences: int = 200):
+    teacher = Translator(uncached_config(teacher_config))
+    student = Translator(uncached_config(config))
+    sources, targets = validation_sources(config, num_sentences)
+
+    teacher_out, teacher_time = timed_translate(teacher, sources, config['val_batch_size'])
+    student_out, student_time = timed_translate(student, sources, config['val_batch_size'])
+
+    bleu = torchmetrics.BLEUScore()
+    references = [[x] for x in targets]
+    print(f"Sentences:                 {len(sources)}")
+    print(f"Parameters teacher / student: {sum(p.numel() for p in teacher.model.parameters()) / 1e6:.1f}M / {sum(p.numel() for p in student.model.parameters()) / 1e6:.1f}M")
+    print(f"Latency teacher / student: {1000 * teacher_time / len(sources):.1f} / {1000 * student_time / len(sources):.1f} ms per sentence ({teacher_time / student_time:.2f}x)")
+    print(f"BLEU teacher / student:    {float(bleu(teacher_out, references)):.4f} / {float(bleu(student_out, references)):.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Distill the trained model into a smaller student model")
+    parser.add_argument('command', choices=['train', 'report'])
+    args = parser.parse_args()
+    if args.command == 'train':
+        distill(get_student_config(), get_config())
+    else:
+        report(get_student_config(), get_config())
@@ -0,0 +1,216 @@
+import argparse
+import math
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+import torch.multiprocessing as mp
+
+from translate import Translator, uncached_config, validation_sources
+from config import get_config
+
+# Multi-instance CPU inference: K replica processes, each pinned to its own cores with its own torch thread
+# count, translate batches side by side. Small decode-step matmuls don't scale to many threads, several
+# replicas with a few threads each keep more cores busy. The fp32 weights are loaded once and moved to
+# shared memory, the replicas map the same pages instead of holding K copies (int8 models are loaded by
+# every replica, their packed weights can't be shared)
+#   python engine.py < sentences.txt
+#   python engine.py --tune --cores 16
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+def replica_worker(replica, config, model, cores, threads, requests, results):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    try:
+        translator = Translator(config, model=model)
+    except Exception as e:
+        results.put((None, replica, None, repr(e)))
+        return
+    # ready
+    results.put((None, replica, None, None))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        job_id, texts = request
+        try:
+            results.put((job_id, replica, translator.translate_batch(texts), None))
+        except Exception as e:
+            results.put((job_id, replica, None, repr(e)))
+
+class InferenceEngine:
+    # Dispatcher: every batch goes to the replica with the fewest sentences in flight, a thread collects the
+    # results and completes the futures returned by submit()
+
+    def __init__(self, config, replicas: int, threads: int = None, cores=None, model=None) -> None:
+        self.config = config
+        self.max_batch_size = config['engine_max_batch_size']
+        cores = cores if cores is not None else available_cores()
+        threads = threads or max(1, len(cores) // replicas)
+        if replicas * threads > len(cores):
+            raise ValueError(f"{replicas} replicas x {threads} threads need more than the {len(cores)} available cores")
+        self.replicas = replicas
+        self.threads = threads
+
+        quantized = config['int8_inference']
+        if model is None and not quantized:
+            model = Translator(uncached_config(config)).model
+        if model is not None:
+            model.share_memory()
+
+        # spawn: the replicas start their OpenMP thread pools from scratch with their own affinity
+        ctx = mp.get_context('spawn')
+        self.results = ctx.Queue()
+        self.requests = [ctx.Queue() for _ in range(replicas)]
+        self.processes = []
+        for replica in range(replicas):
+            replica_cores = cores[replica * threads:(replica + 1) * threads]
+            process = ctx.Process(target=replica_worker, args=(replica, config, model, replica_cores, threads, self.requests[replica], self.results), daemon=True)
+            process.start()
+            self.processes.append(process)
+        # seconds between the liveness checks of the replicas
+        self.poll_interval = 1.0
+        ready = 0
+        while ready < replicas:
+            try:
+                _, replica, _, error = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # a replica killed while loading never reports back
+                dead = [i for i, process in enumerate(self.processes) if not process.is_alive()]
+                if not dead:
+                    continue
+                replica, error = dead[0], f"exit code {self.processes[dead[0]].exitcode}"
+            if error is not None:
+                for process in self.processes:
+                    process.terminate()
+                raise RuntimeError(f"Replica {replica} failed to start: {error}")
+            ready += 1
+
+        self.lock = threading.Lock()
+        # job id -> (future, number of sentences, replica)
+        self.pending = {}
+        self.dead = set()
+        self.in_flight = [0] * replicas
+        self.next_job_id = 0
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, texts):
+        # one batch (at most engine_max_batch_size sentences) -> Future of its translations
+        future = Future()
+        with self.lock:
+            alive = [i for i in range(self.replicas) if i not in self.dead]
+            if not alive:
+                raise RuntimeError("All replicas have died")
+            replica = min(alive, key=lambda i: self.in_flight[i])
+            job_id, self.next_job_id = self.next_job_id, self.next_job_id + 1
+            self.in_flight[replica] += len(texts)
+            self.pending[job_id] = (future, len(texts), replica)
+        self.requests[replica].put((job_id, list(texts)))
+        return future
+
+    def _collect(self):
+        last_check = time.perf_counter()
+        while True:
+            try:
+                result = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                result = None
+            if result is not None:
+                job_id, replica, translations, error = result
+                if job_id is None:
+                    # sent by close()
+                    break
+                with self.lock:
+                    # missing: the job was already failed because its replica was found dead
+                    future, size, _ = self.pending.pop(job_id, (None, 0, replica))
+                    self.in_flight[replica] -= size
+                if future is not None:
+                    if error is not None:
+                        future.set_exception(RuntimeError(f"Replica {replica}: {error}"))
+                    else:
+                        future.set_result(translations)
+            # checked every poll_interval, also while the other replicas keep answering
+            if time.perf_counter() - last_check >= self.poll_interval:
+                self._check_replicas()
+                last_check = time.perf_counter()
+
+    def _check_replicas(self):
+        # fail the jobs of replicas that died (OOM kill, segfault), the dispatcher stops sending them work
+        for replica, process in enumerate(self.processes):
+            if replica in self.dead or process.is_alive():
+                continue
+            with self.lock:
+                self.dead.add(replica)
+                failed = [job_id for job_id, (_, _, r) in self.pending.items() if r == replica]
+                futures = [self.pending.pop(job_id)[0] for job_id in failed]
+                self.in_flight[replica] = 0
+            for future in futures:
+                future.set_exception(RuntimeError(f"Replica {replica} died (exit code {process.exitcode})"))
+
+    def translate_batch(self, texts):
+        # spread a large batch over all the replicas
+        batch_size = max(1, min(self.max_batch_size, math.ceil(len(texts) / self.replicas)))
+        futures = [self.submit(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+        return [translation for future in futures for translation in future.result()]
+
+    def translate(self, text):
+        return self.submit([text]).result()[0]
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put((None, None, None, None))
+        self.collector.join()
+
+def tune(config, texts, num_cores: int = None, batch_size: int = 8):
+    # Throughput of every split of num_cores into replicas x threads per replica, on batches of batch_size
+    cores = available_cores()[:num_cores]
+    model = None if config['int8_inference'] else Translator(uncached_config(config)).model
+    config = dict(uncached_config(config), engine_max_batch_size=batch_size)
+    results = []
+    for replicas in [r for r in range(1, len(cores) + 1) if len(cores) % r == 0]:
+        threads = len(cores) // replicas
+        engine = InferenceEngine(config, replicas, threads, cores, model)
+        try:
+            # warm up every replica
+            engine.translate_batch(texts[:replicas])
+            start = time.perf_counter()
+            engine.translate_batch(texts)
+            elapsed = time.perf_counter() - start
+        finally:
+            engine.close()
+        results.append((replicas, threads, len(texts) / elapsed))
+        print(f"{replicas:3d} replicas x {threads:3d} threads: {len(texts) / elapsed:8.1f} sentences/sec")
+    replicas, threads, throughput = max(results, key=lambda r: r[2])
+    print(f"Best on {len(cores)} cores: {replicas} replicas x {threads} threads ({throughput:.1f} sentences/sec)")
+    return replicas, threads
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-instance CPU translation engine")
+    parser.add_argument('--tune', action='store_true', help="find the best replicas x threads split")
+    parser.add_argument('--cores', type=int, default=None, help="cores to use, default: all available")
+    parser.add_argument('--num_sentences', type=int, default=256, help="validation sentences translated per split when tuning")
+    args = parser.parse_args()
+    config = get_config()
+
+    if args.tune:
+        texts, _ = validation_sources(config, args.num_sentences)
+        tune(config, texts, args.cores)
+    else:
+        engine = InferenceEngine(config, config['engine_replicas'], config['engine_threads'], available_cores()[:args.cores])
+        try:
+            for translation in engine.translate_batch([line.strip() for line in sys.stdin]):
+                print(translation)
+        finally:
+            engine.close()
@@ -0,0 +1,254 @@
+import argparse
+import tempfile
+import torch
+import torch.nn as nn
+from pathlib import Path
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+
+from model import LengthMask, build_transformer
+from train import batch_greedy_decode
+from translate import Translator, uncached_config, validation_sources
+from config import get_config, latest_weights_file_path
+
+# Static-shape TorchScript graphs for inference: one graph for Transformer.encode (plus the cross attention
+# keys/values of every decoder layer) and one for a single incremental greedy decode step, traced for a few
+# (batch size, source length) buckets. The decode step writes its self attention keys/values in place into
+# preallocated cache tensors, which come in a few target lengths: decoding starts with the shortest cache and
+# only moves to a longer one (a single copy) when the translation outgrows it. The graphs take the weights as
+# an input instead of storing them: the weights are saved once (weights.pt) and shared by every bucket graph
+#   python export.py          export the graphs of the latest checkpoint, compare with the eager model
+#   python export.py --test   parity test of the export on a tiny random model
+
+class EncodeGraph(nn.Module):
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, src, src_lengths):
+        # (batch, src_len) -> 2 x (N, batch, h, src_len, d_k)
+        memory_kvs = self.model.precompute_memory(self.model.encode(src, LengthMask(src_lengths)))
+        return torch.stack([key for key, _ in memory_kvs]), torch.stack([value for _, value in memory_kvs])
+
+class DecodeStepGraph(nn.Module):
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, token, pos, self_keys, self_values, memory_keys, memory_values, src_lengths):
+        # token (batch, 1) at position pos (1) -> next token (batch). The keys/values of the token are written
+        # in place into self_keys / self_values (N, batch, h, tgt_len, d_k)
+        x = self.model.tgt_embed(token) + self.model.tgt_pos.pe[:, pos]
+        self_mask = (torch.arange(self_keys.shape[3], device=pos.device) <= pos).view(1, 1, 1, -1)
+        # per layer views of the caches, MultiHeadAttentionBlock updates them with index_copy_
+        kv_caches = [{'key': self_keys[i], 'value': self_values[i], 'pos': pos} for i in range(self_keys.shape[0])]
+        memory_kvs = [(memory_keys[i], memory_values[i]) for i in range(memory_keys.shape[0])]
+        out = self.model.decoder(x, None, LengthMask(src_lengths), self_mask, kv_caches, memory_kvs)
+        return self.model.project(out[:, -1]).argmax(dim=-1)
+
+class WeightsAsInput(nn.Module):
+    # Runs step (EncodeGraph / DecodeStepGraph) with its parameters and buffers passed in as a tuple of tensors.
+    # step is deliberately not a submodule, so a graph traced from this module holds no copy of the weights
+
+    def __init__(self, step: nn.Module) -> None:
+        super().__init__()
+        self.__dict__['step'] = step
+        self.names = list(model_weights(step))
+
+    def forward(self, weights, inputs):
+        return torch.func.functional_call(self.step, dict(zip(self.names, weights)), inputs)
+
+def model_weights(module):
+    # parameters and buffers by name, in the order the graphs take them
+    return {**dict(module.named_parameters()), **dict(module.named_buffers())}
+
+def export_buckets(config):
+    # batch sizes, source lengths and target (cache) lengths the graphs are traced for,
+    # the longest source bucket and cache hold a whole seq_len sentence
+    seq_len = config['seq_len']
+    src_lens = sorted({min(s, seq_len) for s in config['export_src_lens']} | {seq_len})
+    tgt_lens = sorted({min(t, seq_len) for t in config['export_tgt_lens']} | {seq_len})
+    return sorted(config['export_batch_sizes']), src_lens, tgt_lens
+
+def graph_path(folder, kind, batch_size, src_len, tgt_len=None):
+    suffix = f"_t{tgt_len}" if tgt_len is not None else ""
+    return Path(folder) / f"{kind}_b{batch_size}_s{src_len}{suffix}.pt"
+
+def get_compiled_folder(config):
+    return f"{config['datasource']}_{config['model_folder']}_compiled"
+
+@torch.no_grad()
+def export_graphs(model, folder, batch_sizes, src_lens, tgt_lens):
+    model.eval()
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    encode_step, decode_step = WeightsAsInput(EncodeGraph(model)), WeightsAsInput(DecodeStepGraph(model))
+    # EncodeGraph and DecodeStepGraph wrap the same model, their weights have the same names and order
+    weights = model_weights(encode_step.step)
+    torch.save({'names': list(weights), 'weights': [w.detach() for w in weights.values()]}, folder / 'weights.pt')
+    weights = tuple(weights.values())
+
+    num_layers = len(model.decoder.layers)
+    attention = model.decoder.layers[0].self_attention_block
+    for batch_size in batch_sizes:
+        for src_len in src_lens:
+            src = torch.zeros(batch_size, src_len, dtype=torch.int64)
+            src_lengths = torch.full((batch_size,), src_len, dtype=torch.int64)
+            encode = torch.jit.trace(encode_step, (weights, (src, src_lengths)), check_trace=False)
+            torch.jit.save(encode, str(graph_path(folder, 'encode', batch_size, src_len)))
+
+            memory_keys, memory_values = encode(weights, (src, src_lengths))
+            for tgt_len in tgt_lens:
+                cache = torch.zeros(num_layers, batch_size, attention.h, tgt_len, attention.d_k)
+                example = (torch.zeros(batch_size, 1, dtype=torch.int64), torch.zeros(1, dtype=torch.int64), cache, cache.clone(), memory_keys, memory_values, src_lengths)
+                decode = torch.jit.trace(decode_step, (weights, example), check_trace=False)
+                torch.jit.save(decode, str(graph_path(folder, 'decode', batch_size, src_len, tgt_len)))
+
+class CompiledDecoder:
+    # Greedy decoding with the exported graphs: the batch is padded up to the smallest (batch size, source length)
+    # bucket that fits, the loop only calls the decode step graph and checks for </s>
+
+    def __init__(self, folder, batch_sizes, src_lens, tgt_lens, sos_idx: int, eos_idx: int, pad_idx: int) -> None:
+        self.batch_sizes, self.src_lens, self.tgt_lens = batch_sizes, src_lens, tgt_lens
+        self.sos_idx, self.eos_idx, self.pad_idx = sos_idx, eos_idx, pad_idx
+        # the one copy of the weights, passed to every graph call
+        self.weights = tuple(torch.load(Path(folder) / 'weights.pt', map_location='cpu')['weights'])
+        self.encode_graphs = {}
+        self.decode_graphs = {}
+        for batch_size in batch_sizes:
+            for src_len in src_lens:
+                self.encode_graphs[batch_size, src_len] = torch.jit.load(str(graph_path(folder, 'encode', batch_size, src_len)))
+                for tgt_len in tgt_lens:
+                    self.decode_graphs[batch_size, src_len, tgt_len] = torch.jit.load(str(graph_path(folder, 'decode', batch_size, src_len, tgt_len)))
+
+    def encode(self, source, src_lengths):
+        batch_size = next(b for b in self.batch_sizes if b >= source.size(0))
+        src_len = next((s for s in self.src_lens if s >= source.size(1)), None)
+        if src_len is None:
+            raise ValueError(f"Source of {source.size(1)} tokens is longer than the largest exported bucket")
+        # pad the batch up to the bucket shape, the extra rows are a single [PAD] token
+        padded = torch.full((batch_size, src_len), self.pad_idx, dtype=torch.int64)
+        padded[:source.size(0), :source.size(1)] = source
+        padded_lengths = torch.ones(batch_size, dtype=torch.int64)
+        padded_lengths[:source.size(0)] = src_lengths
+        memory_keys, memory_values = self.encode_graphs[batch_size, src_len](self.weights, (padded, padded_lengths))
+        return (batch_size, src_len), memory_keys, memory_values, padded_lengths
+
+    def decode(self, encoded, num_sentences: int):
+        # -> (num_sentences, longest target length) token ids, everything after </s> is [PAD]
+        (batch_size, src_len), memory_keys, memory_values, src_lengths = encoded
+        max_len = self.tgt_lens[-1]
+        tgt_len = self.tgt_lens[0]
+        num_layers, _, h, _, d_k = memory_keys.shape
+        self_keys = torch.zeros(num_layers, batch_size, h, tgt_len, d_k, dtype=memory_keys.dtype)
+        self_values = torch.zeros_like(self_keys)
+
+        decoder_output = torch.full((batch_size, max_len), self.pad_idx, dtype=torch.int64)
+        decoder_output[:, 0] = self.sos_idx
+        # the rows added to fill the bucket count as finished from the start
+        finished = torch.arange(batch_size) >= num_sentences
+        token = decoder_output[:, :1]
+        for step in range(1, max_len):
+            pos = step - 1
+            if pos == tgt_len:
+                # the cache is full: continue in the next longer one
+                tgt_len = next(t for t in self.tgt_lens if t > pos)
+                self_keys = nn.functional.pad(self_keys, (0, 0, 0, tgt_len - pos))
+                self_values = nn.functional.pad(self_values, (0, 0, 0, tgt_len - pos))
+            next_word = self.decode_graphs[batch_size, src_len, tgt_len](self.weights, (token, torch.tensor([pos]), self_keys, self_values, memory_keys, memory_values, src_lengths))
+            next_word = next_word.masked_fill(finished, self.pad_idx)
+            decoder_output[:, step] = next_word
+            finished = finished | (next_word == self.eos_idx)
+            if finished.all():
+                break
+            token = next_word.unsqueeze(1)
+        return decoder_output[:num_sentences]
+
+    def greedy(self, source, src_lengths):
+        return self.decode(self.encode(source, src_lengths), source.size(0))
+
+class CompiledTranslator(Translator):
+    # Translator running the exported graphs through a CompiledDecoder instead of an eager model
+
+    def __init__(self, config, folder=None) -> None:
+        self.folder = folder or get_compiled_folder(config)
+        # the graphs only do greedy decoding of whole batches, without encoder cache or shortlist
+        super().__init__(dict(config, encoder_cache_mb=0, vocab_shortlist=False), quantized=False)
+
+    def load_model(self, weights_file, model):
+        self.weights_file = None
+        self.decoder = CompiledDecoder(self.folder, *export_buckets(self.config), self.sos_idx, self.eos_idx, self.pad_idx)
+        return None
+
+    def translate_batch(self, texts):
+        # larger batches than the biggest bucket are split
+        step = self.decoder.batch_sizes[-1]
+        translations = []
+        for i in range(0, len(texts), step):
+            translations.extend(super().translate_batch(texts[i:i + step]))
+        return translations
+
+    def encode_batch(self, ids, source, source_mask):
+        return self.decoder.encode(source, source_mask.lengths)
+
+    def decode_batch(self, source, source_mask, encoder_output=None):
+        return self.decoder.decode(encoder_output, source.size(0))
+
+@torch.inference_mode()
+def check_parity(eager: Translator, compiled: CompiledTranslator, texts, batch_size: int = 8):
+    # number of texts whose greedy tokens from the exported graphs differ from the eager model (batch_greedy_decode)
+    mismatches = 0
+    for i in range(0, len(texts), batch_size):
+        ids = eager.tokenize(texts[i:i + batch_size])
+        source, source_mask = eager.encode_sources(ids)
+        expected = batch_greedy_decode(eager.model, source, source_mask, eager.tokenizer_src, eager.tokenizer_tgt, eager.seq_len, eager.device)
+        actual = compiled.decoder.greedy(source, source_mask.lengths)
+        mismatches += int((expected != actual).any(dim=1).sum())
+    return mismatches
+
+@torch.no_grad()
+def parity_test(seq_len: int = 24, vocab_size: int = 40):
+    # Export a tiny random model and check that the graphs give the encoder memory and the greedy tokens of
+    # the eager model, for padded batches, padded sources and a translation that outgrows the first cache
+    torch.manual_seed(0)
+    model = build_transformer(vocab_size, vocab_size, seq_len, seq_len, d_model=32, N=2, h=4, d_ff=64).eval()
+    tokenizer = Tokenizer(WordLevel({'[UNK]': 0, '[PAD]': 1, '[SOS]': 2, '[EOS]': 3}, unk_token='[UNK]'))
+    batch_sizes, src_lens, tgt_lens = [1, 4], [8, 16], [8, seq_len]
+    with tempfile.TemporaryDirectory() as folder:
+        export_graphs(model, folder, batch_sizes, src_lens, tgt_lens)
+        compiled = CompiledDecoder(folder, batch_sizes, src_lens, tgt_lens, sos_idx=2, eos_idx=3, pad_idx=1)
+        for num_sentences, src_len in [(1, 5), (3, 12), (4, 16)]:
+            lengths = torch.randint(3, src_len + 1, (num_sentences,))
+            lengths[0] = src_len
+            source = torch.full((num_sentences, src_len), 1, dtype=torch.int64)
+            for i, length in enumerate(lengths.tolist()):
+                source[i, 0] = 2
+                source[i, 1:length - 1] = torch.randint(4, vocab_size, (length - 2,))
+                source[i, length - 1] = 3
+            source_mask = LengthMask(lengths)
+
+            encoded = compiled.encode(source, lengths)
+            memory_keys = torch.stack([key for key, _ in model.precompute_memory(model.encode(source, source_mask))])
+            assert torch.allclose(encoded[1][:, :num_sentences, :, :src_len], memory_keys, atol=1e-5), "encoder memory differs"
+
+            expected = batch_greedy_decode(model, source, source_mask, tokenizer, tokenizer, seq_len, torch.device('cpu'))
+            actual = compiled.decode(encoded, num_sentences)
+            assert torch.equal(expected, actual), f"greedy tokens differ:\n{expected}\n{actual}"
+    print("Exported graphs match the eager model")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export static-shape TorchScript graphs for encode and decode step")
+    parser.add_argument('--test', action='store_true', help="parity test on a tiny random model, no checkpoint or dataset needed")
+    args = parser.parse_args()
+    if args.test:
+        parity_test()
+    else:
+        config = uncached_config(get_config())
+        eager = Translator(config, latest_weights_file_path(config))
+        export_graphs(eager.model, get_compiled_folder(config), *export_buckets(config))
+        compiled = CompiledTranslator(config)
+
+        texts, _ = validation_sources(config, 64)
+        mismatches = check_parity(eager, compiled, texts)
+        print(f"Exported graphs to {get_compiled_folder(config)}: {mismatches} / {len(texts)} translations differ from the eager model")
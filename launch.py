@@ -0,0 +1,40 @@
+import argparse
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+from config import get_config
+from train import train_model
+
+# Starts nproc_per_node training processes on this machine for distributed data parallel training (gloo).
+# Single machine:   python launch.py --nproc_per_node 4
+# Several machines: run on every host with the same --nnodes / --master_addr / --master_port and its own --node_rank.
+# Every machine builds its own tokenizers and token cache (checked to match), checkpoints are only written on the
+# machine of node_rank 0 and sent to the others when resuming, so no shared filesystem is needed
+
+def worker(local_rank, args):
+    rank = args.node_rank * args.nproc_per_node + local_rank
+    os.environ['MASTER_ADDR'] = args.master_addr
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    os.environ['WORLD_SIZE'] = str(args.nnodes * args.nproc_per_node)
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    # split the cores of the machine between its processes
+    torch.set_num_threads(args.threads)
+    train_model(get_config())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Distributed data parallel training on CPU")
+    parser.add_argument('--nproc_per_node', type=int, default=2)
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node_rank', type=int, default=0)
+    parser.add_argument('--master_addr', type=str, default='127.0.0.1')
+    parser.add_argument('--master_port', type=int, default=29500)
+    parser.add_argument('--threads', type=int, default=None, help="threads per process, default: cores / nproc_per_node")
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() or 1) // args.nproc_per_node)
+
+    mp.spawn(worker, args=(args,), nprocs=args.nproc_per_node, join=True)
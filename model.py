@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 import math
+from functools import lru_cache
+from torch.utils.checkpoint import checkpoint
 
 class InputEmbeddings(nn.Module):
     def __init__(self, d_model: int, vocab_size: int) -> None:
@@ -32,14 +34,19 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0) # (1, seq_len, d_model)
         self.register_buffer('pe', pe) # pytorch buffer, not considered for model training and weights wont be updated
 
-    def forward(self, x):
+    def forward(self, x, start_pos: int = 0, positions=None):
         # self.pe[:, :] This would select the entire positional encoding matrix.
         # self.pe[:, :x.shape[1]] This selects only the columns of the positional encoding matrix up to the size of the input sequence x. 
         # This is done to match the length of the positional encoding with the length of the input sequence
         
         # In summary, self.pe[:, : x.shape[1]] extracts the relevant part of the positional encoding matrix 
         # that aligns with the length of the input sequence x.
-        x = x + self.pe[:, :x.shape[1]].requires_grad_(False)
+        if positions is not None:
+            # (batch, seq_len) explicit position of every token, e.g. restarting at 0 for every packed sentence
+            x = x + self.pe[0, positions].requires_grad_(False)
+        else:
+            # start_pos shifts the window when decoding incrementally, one new token at a time
+            x = x + self.pe[:, start_pos:start_pos + x.shape[1]].requires_grad_(False)
         return self.dropout(x)
 
 class LayerNormalisation(nn.Module):
@@ -50,9 +57,21 @@ class LayerNormalisation(nn.Module):
         self.bias = nn.Parameter(torch.zeros(features)) # so both alpha and bias are learnable
         
     def forward(self, x):
-        mean = x.mean(dim = -1, keepdim=True)
-        std = x.std(dim=-1, keepdim=True)
-        return self.alpha * (x - mean) / (std + self.eps) + self.bias
+        # always in fp32, also under bfloat16 autocast (the statistics are too imprecise in bf16)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            mean = x.mean(dim = -1, keepdim=True)
+            std = x.std(dim=-1, keepdim=True)
+            return self.alpha * (x - mean) / (std + self.eps) + self.bias
+
+class FusedLayerNormalisation(LayerNormalisation):
+    # Same parameters and result as LayerNormalisation, but the mean and std come from a single
+    # reduction (std_mean) and the scale + shift is one addcmul, fewer passes over x and fewer temporaries
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            std, mean = torch.std_mean(x, dim=-1, keepdim=True)
+            return torch.addcmul(self.bias, self.alpha, (x - mean) / (std + self.eps))
 
 class FeedForwardBlock(nn.Module):
     def __init__(self, d_model: int, d_ff: int, dropout: float) -> None:
@@ -67,6 +86,58 @@ class FeedForwardBlock(nn.Module):
         x = self.linear_2(x) #(batch, seq_len, d_ff) -> (batch, seq_len, d_model)
         return x
 
+@lru_cache(maxsize=64)
+def shared_causal_mask(q_len: int, k_len: int, device) -> torch.Tensor:
+    # (1, 1, q_len, k_len) built once per shape and reused by every batch and layer.
+    # The queries are the last q_len positions (k_len > q_len when decoding with a kv cache)
+    return torch.ones(q_len, k_len, dtype=torch.bool, device=device).tril(diagonal=k_len - q_len).unsqueeze(0).unsqueeze(0)
+
+class LengthMask:
+    # Compact attention mask: the number of real (non [PAD]) tokens of every sequence, optionally causal.
+    # It is turned into a boolean (batch, 1, q_len, k_len) mask inside the attention block only
+    def __init__(self, lengths: torch.Tensor, causal: bool = False) -> None:
+        self.lengths = lengths # (batch)
+        self.causal = causal
+
+    def to(self, device):
+        return LengthMask(self.lengths.to(device), self.causal)
+
+    def __getitem__(self, index):
+        return LengthMask(self.lengths[index], self.causal)
+
+    def materialize(self, q_len: int, k_len: int) -> torch.Tensor:
+        # (batch, k_len) -> (batch, 1, 1, k_len) hide the [PAD] keys
+        mask = torch.arange(k_len, device=self.lengths.device) < self.lengths.unsqueeze(1)
+        mask = mask.unsqueeze(1).unsqueeze(1)
+        if self.causal:
+            # (batch, 1, 1, k_len) & (1, 1, q_len, k_len) -> (batch, 1, q_len, k_len)
+            mask = mask & shared_causal_mask(q_len, k_len, self.lengths.device)
+        return mask
+
+class SegmentMask:
+    # Block diagonal attention mask for packed rows (several sentences per row): a query only sees
+    # the keys of its own segment. Segment ids start at 1, 0 is [PAD]. Padding queries may look at
+    # every key so that no row is fully masked, their output is never used
+    def __init__(self, q_segments: torch.Tensor, k_segments: torch.Tensor, causal: bool = False) -> None:
+        self.q_segments = q_segments # (batch, q_len)
+        self.k_segments = k_segments # (batch, k_len)
+        self.causal = causal
+
+    def to(self, device):
+        return SegmentMask(self.q_segments.to(device), self.k_segments.to(device), self.causal)
+
+    def __getitem__(self, index):
+        return SegmentMask(self.q_segments[index], self.k_segments[index], self.causal)
+
+    def materialize(self, q_len: int, k_len: int) -> torch.Tensor:
+        # (batch, q_len, 1) == (batch, 1, k_len) -> (batch, 1, q_len, k_len)
+        q_segments = self.q_segments[:, -q_len:].unsqueeze(2)
+        mask = (q_segments == self.k_segments[:, :k_len].unsqueeze(1)) | (q_segments == 0)
+        mask = mask.unsqueeze(1)
+        if self.causal:
+            mask = mask & shared_causal_mask(q_len, k_len, self.q_segments.device)
+        return mask
+
 class MultiHeadAttentionBlock(nn.Module):
     def __init__(self, d_model: int, h: int, dropout: float) -> None:
         super().__init__()
@@ -81,6 +152,13 @@ class MultiHeadAttentionBlock(nn.Module):
         
         self.w_o = nn.Linear(d_model, d_model) # Wo    
         self.dropout = nn.Dropout(dropout)
+        
+        # 'math' (attention() below), 'sdpa' (torch fused scaled_dot_product_attention) or 'chunked' (chunked_attention())
+        self.backend = 'math'
+        self.chunk_size = 128
+        # the attention scores are only kept when asked for (visualization), they are (batch, h, seq_len, seq_len) per layer
+        self.capture_scores = False
+        self.attention_scores = None
 
     @staticmethod # this means I can call this funciton without having an instance of this class. so I can say class_name.this_function
     def attention(query, key, value, mask, dropout: nn.Dropout):
@@ -92,24 +170,109 @@ class MultiHeadAttentionBlock(nn.Module):
         
         if mask is not None:
             attention_scores.masked_fill_(mask == 0, -1e9)
-        attention_scores = attention_scores.softmax(dim = -1) # (batch, h, seq_len, seq_len)
+        # softmax in fp32 (no-op unless running under bfloat16 autocast)
+        attention_scores = attention_scores.softmax(dim = -1, dtype=torch.float32).to(value.dtype) # (batch, h, seq_len, seq_len)
         
         if dropout is not None:
             attention_scores = dropout(attention_scores)
         
         return (attention_scores @ value), attention_scores
 
-    def forward(self, q, k, v, mask):
-        query = self.w_q(q) # (batch, seq_len, d_model) * w_q=(batch, d_model, d_model) --> (batch, seq_len, d_model)
+    @staticmethod
+    def chunked_attention(query, key, value, mask, dropout: nn.Dropout, chunk_size: int):
+        # Same as attention(), but only chunk_size queries at a time, so the score matrix
+        # is at most (batch, h, chunk_size, seq_len) instead of (batch, h, seq_len, seq_len)
+        outputs = []
+        for start in range(0, query.shape[2], chunk_size):
+            chunk_mask = mask
+            if mask is not None and mask.shape[2] > 1:
+                chunk_mask = mask[:, :, start:start + chunk_size]
+            x, _ = MultiHeadAttentionBlock.attention(query[:, :, start:start + chunk_size], key, value, chunk_mask, dropout)
+            outputs.append(x)
+        return torch.cat(outputs, dim=2)
+
+    def project_kv(self, k, v):
         key = self.w_k(k)   # (batch, seq_len, d_model) * w_k=(batch, d_model, d_model) --> (batch, seq_len, d_model)
         value = self.w_v(v) # (batch, seq_len, d_model) * w_v=(batch, d_model, d_model) --> (batch, seq_len, d_model)
         
         # (batch, seq_len, d_model) -> (batch, seq_len, h, d_k) -> (batch, h, seq_len, d_k)
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
         key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
         value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return key, value
+
+    def project_qkv(self, q, k, v, memory_kv):
+        query = self.w_q(q) # (batch, seq_len, d_model) * w_q=(batch, d_model, d_model) --> (batch, seq_len, d_model)
+        # (batch, seq_len, d_model) -> (batch, seq_len, h, d_k) -> (batch, h, seq_len, d_k)
+        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
+        
+        # memory_kv is the (key, value) pair already projected by project_kv, e.g. the encoder output
+        # projected once per source sentence for cross attention (see Transformer.precompute_memory)
+        if memory_kv is not None:
+            key, value = memory_kv
+        else:
+            key, value = self.project_kv(k, v)
+        return query, key, value
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved from a FusedMultiHeadAttentionBlock have a single packed w_qkv
+        for name in ('weight', 'bias'):
+            if prefix + 'w_qkv.' + name in state_dict:
+                packed = state_dict.pop(prefix + 'w_qkv.' + name)
+                for key, tensor in zip(('w_q', 'w_k', 'w_v'), packed.chunk(3, dim=0)):
+                    state_dict[prefix + key + '.' + name] = tensor
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, q, k, v, mask, kv_cache=None, memory_kv=None):
+        query, key, value = self.project_qkv(q, k, v, memory_kv)
+        
+        # Beam search keeps one copy of the memory per sentence for all its beams (batch = sentences * beams).
+        # Fold the beams into the query length so every beam attends to the same (batch, h, seq_len, d_k) memory
+        beams = query.shape[0] // key.shape[0]
+        if beams > 1:
+            # (batch * beams, h, seq_len, d_k) -> (batch, beams, h, seq_len, d_k) -> (batch, h, beams * seq_len, d_k)
+            seq_len = query.shape[2]
+            query = query.view(key.shape[0], beams, self.h, seq_len, self.d_k).transpose(1, 2).reshape(key.shape[0], self.h, -1, self.d_k)
+        
+        # kv_cache is a dict holding the keys and values of the earlier positions (incremental decoding).
+        # The new keys/values are appended so only the newest tokens have to be projected at each step
+        if kv_cache is not None:
+            if 'pos' in kv_cache:
+                # static cache preallocated to a fixed length (exported decode step, see export.py): the new
+                # keys/values are written in place at position pos, the mask hides the slots after it
+                key = kv_cache['key'].index_copy_(2, kv_cache['pos'], key) # (batch, h, max_len, d_k)
+                value = kv_cache['value'].index_copy_(2, kv_cache['pos'], value)
+            elif 'key' in kv_cache:
+                key = torch.cat([kv_cache['key'], key], dim=2) # (batch, h, past_len + seq_len, d_k)
+                value = torch.cat([kv_cache['value'], value], dim=2)
+            kv_cache['key'] = key
+            kv_cache['value'] = value
+        
+        if isinstance(mask, (LengthMask, SegmentMask)):
+            mask = mask.materialize(query.shape[2], key.shape[2])
+        
+        if mask is not None and mask.dtype != torch.bool:
+            mask = mask != 0
+        
+        if self.capture_scores or self.backend == 'math':
+            x, attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+            if self.capture_scores:
+                self.attention_scores = attention_scores
+        elif self.backend == 'sdpa':
+            if query.dtype == torch.float32:
+                dropout_p = self.dropout.p if self.training else 0.0
+                x = nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_p)
+            else:
+                # bfloat16 autocast: whether an SDPA kernel keeps the softmax in fp32 depends on the kernel, the math
+                # path runs the two matmuls in bf16 and only the scores' softmax in fp32
+                x, _ = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        elif self.backend == 'chunked':
+            x = MultiHeadAttentionBlock.chunked_attention(query, key, value, mask, self.dropout, self.chunk_size)
+        else:
+            raise ValueError(f"Unknown attention backend: {self.backend}")
         
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if beams > 1:
+            # (batch, h, beams * seq_len, d_k) -> (batch, beams, h, seq_len, d_k) -> (batch * beams, h, seq_len, d_k)
+            x = x.view(key.shape[0], self.h, beams, seq_len, self.d_k).transpose(1, 2).reshape(-1, self.h, seq_len, self.d_k)
         
         # (batch, h, seq_len, d_k) -> (batch, seq_len, h, d_k) -> (batch, seq_len, d_model)
         x = x.transpose(1, 2).contiguous().view(x.shape[0], -1, self.h * self.d_k) # d_model = self.h*self.d_k
@@ -117,6 +280,50 @@ class MultiHeadAttentionBlock(nn.Module):
         # (batch, seq_len, d_model) -> (batch, seq_len, d_model)
         return self.w_o(x)
 
+class FusedMultiHeadAttentionBlock(MultiHeadAttentionBlock):
+    # w_q, w_k and w_v packed into one (3 * d_model, d_model) linear layer: self attention runs a single GEMM
+    # for Q, K and V, cross attention a single GEMM for K and V. Checkpoints of MultiHeadAttentionBlock
+    # (separate w_q / w_k / w_v) are packed when loaded, see _load_from_state_dict
+    def __init__(self, d_model: int, h: int, dropout: float) -> None:
+        super().__init__(d_model, h, dropout)
+        del self.w_q, self.w_k, self.w_v
+        self.w_qkv = nn.Linear(d_model, 3 * d_model) # [Wq; Wk; Wv]
+
+    def project_kv(self, k, v):
+        weight, bias = self.w_qkv.weight[self.d_model:], self.w_qkv.bias[self.d_model:]
+        if k is v:
+            # (batch, seq_len, d_model) -> (batch, seq_len, 2, h, d_k) -> (2, batch, h, seq_len, d_k)
+            kv = nn.functional.linear(k, weight, bias)
+            kv = kv.view(kv.shape[0], kv.shape[1], 2, self.h, self.d_k).permute(2, 0, 3, 1, 4)
+            return kv[0], kv[1]
+        key = nn.functional.linear(k, weight[:self.d_model], bias[:self.d_model])
+        value = nn.functional.linear(v, weight[self.d_model:], bias[self.d_model:])
+        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
+        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return key, value
+
+    def project_qkv(self, q, k, v, memory_kv):
+        if memory_kv is None and q is k and k is v:
+            # self attention: (batch, seq_len, d_model) -> (batch, seq_len, 3, h, d_k) -> (3, batch, h, seq_len, d_k)
+            qkv = self.w_qkv(q)
+            qkv = qkv.view(qkv.shape[0], qkv.shape[1], 3, self.h, self.d_k).permute(2, 0, 3, 1, 4)
+            return qkv[0], qkv[1], qkv[2]
+        query = nn.functional.linear(q, self.w_qkv.weight[:self.d_model], self.w_qkv.bias[:self.d_model])
+        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
+        if memory_kv is not None:
+            key, value = memory_kv
+        else:
+            key, value = self.project_kv(k, v)
+        return query, key, value
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of MultiHeadAttentionBlock have separate w_q / w_k / w_v, pack them
+        for name in ('weight', 'bias'):
+            keys = [prefix + key + '.' + name for key in ('w_q', 'w_k', 'w_v')]
+            if all(key in state_dict for key in keys):
+                state_dict[prefix + 'w_qkv.' + name] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        nn.Module._load_from_state_dict(self, state_dict, prefix, *args, **kwargs)
+
 class ResidualConnection(nn.Module):
     def __init__(self, features: int, dropout: float) -> None:
         super().__init__()
@@ -144,10 +351,15 @@ class Encoder(nn.Module):
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalisation(features)
+        # recompute the activations of every block in the backward pass instead of keeping them (training only)
+        self.activation_checkpointing = False
     
     def forward(self, x, mask):
         for layer in self.layers:
-            x = layer(x, mask)
+            if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
         return self.norm(x)
 
 class DecoderBlock(nn.Module):
@@ -158,9 +370,9 @@ class DecoderBlock(nn.Module):
         self.feed_forward_block = feed_forward_block
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
     
-    def forward(self, x, encoder_output, src_mask, tgt_mask): # src_mask is mask applied to encoder. tgt_mask is mask applied to decoder
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
+    def forward(self, x, encoder_output, src_mask, tgt_mask, kv_cache=None, memory_kv=None): # src_mask is mask applied to encoder. tgt_mask is mask applied to decoder
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask, kv_cache))
+        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask, memory_kv=memory_kv))
         x = self.residual_connections[2](x, lambda x: self.feed_forward_block(x)) # POSSIBLE ERROR! self.residual_connections[1](x, self.feed_forward_block) 50:12
         return x
 
@@ -169,10 +381,23 @@ class Decoder(nn.Module):
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalisation(features)
+        # recompute the activations of every block in the backward pass instead of keeping them (training only)
+        self.activation_checkpointing = False
     
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+    def precompute_memory(self, encoder_output):
+        # cross attention (key, value) of every layer, they only depend on the encoder output
+        return [layer.cross_attention_block.project_kv(encoder_output, encoder_output) for layer in self.layers]
+    
+    def forward(self, x, encoder_output, src_mask, tgt_mask, kv_caches=None, memory_kvs=None):
+        # kv_caches holds one self-attention cache per layer, see Transformer.init_kv_cache
+        # memory_kvs holds the projected cross attention keys/values per layer, see Transformer.precompute_memory
+        for i, layer in enumerate(self.layers):
+            kv_cache = kv_caches[i] if kv_caches is not None else None
+            memory_kv = memory_kvs[i] if memory_kvs is not None else None
+            if self.activation_checkpointing and self.training and torch.is_grad_enabled() and kv_cache is None:
+                x = checkpoint(layer, x, encoder_output, src_mask, tgt_mask, None, memory_kv, use_reentrant=False)
+            else:
+                x = layer(x, encoder_output, src_mask, tgt_mask, kv_cache, memory_kv)
         return self.norm(x)
 
 class ProjectionLayer(nn.Module):
@@ -180,9 +405,75 @@ class ProjectionLayer(nn.Module):
         super().__init__()
         self.proj = nn.Linear(d_model, vocab_size)
     
-    def forward(self, x):
-        # (batch, seq_len, d_model) -> (batch, seq_len, vocab_size)
-        return torch.log_softmax(self.proj(x), dim = -1)
+    def forward(self, x, shortlist=None):
+        # (batch, seq_len, d_model) -> (batch, seq_len, vocab_size), or (batch, seq_len, len(vocab)) over the
+        # weights returned by select(vocab)
+        # log_softmax in fp32 (no-op unless running under bfloat16 autocast)
+        logits = self.proj(x) if shortlist is None else nn.functional.linear(x, *shortlist)
+        return torch.log_softmax(logits.float(), dim = -1)
+
+    def select(self, vocab):
+        # rows of the output layer for the target ids in vocab, sliced once and reused for every decode step
+        weight, bias = self.proj.weight, self.proj.bias
+        if callable(weight):
+            # dynamically quantized nn.Linear (quantize.py)
+            weight, bias = weight().dequantize(), bias()
+        return weight[vocab], bias[vocab]
+    
+    @staticmethod
+    def smoothed_nll(log_probs, label, label_smoothing: float):
+        nll = -log_probs.gather(-1, label.unsqueeze(-1)).squeeze(-1)
+        # label smoothing as in nn.CrossEntropyLoss: the smoothed mass is spread uniformly over the vocabulary
+        smooth = -log_probs.mean(dim=-1)
+        return ((1.0 - label_smoothing) * nll + label_smoothing * smooth).sum()
+
+    def _chunk_loss(self, x, label, label_smoothing: float):
+        # (chunk, d_model) -> (chunk, vocab_size)
+        return self.smoothed_nll(self(x), label, label_smoothing)
+    
+    def chunked_loss(self, x, label, ignore_index: int, label_smoothing: float = 0.0, chunk_size: int = 1024):
+        # Same value as nn.CrossEntropyLoss(ignore_index, label_smoothing) on the projected output, but the
+        # projection only runs on the non [PAD] positions, chunk_size of them at a time, and every chunk
+        # is recomputed in the backward pass, so the (batch, seq_len, vocab_size) output never exists
+        keep = label != ignore_index
+        x = x[keep] # (batch, seq_len, d_model) -> (tokens, d_model)
+        label = label[keep] # (tokens)
+        total = x.new_zeros(())
+        for start in range(0, x.shape[0], chunk_size):
+            chunk_x, chunk_label = x[start:start + chunk_size], label[start:start + chunk_size]
+            if torch.is_grad_enabled():
+                total = total + checkpoint(self._chunk_loss, chunk_x, chunk_label, label_smoothing, use_reentrant=False)
+            else:
+                total = total + self._chunk_loss(chunk_x, chunk_label, label_smoothing)
+        return total / max(label.shape[0], 1)
+
+    def _chunk_distillation_loss(self, x, teacher_log_probs, label, alpha: float, temperature: float, label_smoothing: float):
+        log_probs = self(x)
+        hard = self.smoothed_nll(log_probs, label, label_smoothing)
+        # KL(teacher || student) of the distributions softened by temperature, log_softmax(log_probs / T)
+        # equals log_softmax(logits / T) so the projection outputs can be used directly
+        student = torch.log_softmax(log_probs / temperature, dim=-1)
+        teacher = torch.log_softmax(teacher_log_probs / temperature, dim=-1)
+        soft = (teacher.exp() * (teacher - student)).sum()
+        # temperature^2 keeps the gradient scale of the soft term independent of the temperature (Hinton et al. 2015)
+        return (1.0 - alpha) * hard + alpha * temperature ** 2 * soft
+
+    def chunked_distillation_loss(self, x, teacher, teacher_x, label, ignore_index: int, alpha: float = 0.5, temperature: float = 1.0, label_smoothing: float = 0.0, chunk_size: int = 1024):
+        # Knowledge distillation: (1 - alpha) * chunked_loss + alpha * the KL divergence to the soft targets of
+        # teacher (the ProjectionLayer of the teacher model) on its decoder output teacher_x, computed on the
+        # non [PAD] positions chunk by chunk like chunked_loss
+        keep = label != ignore_index
+        x, teacher_x, label = x[keep], teacher_x[keep], label[keep]
+        total = x.new_zeros(())
+        for start in range(0, x.shape[0], chunk_size):
+            chunk_x, chunk_label = x[start:start + chunk_size], label[start:start + chunk_size]
+            with torch.no_grad():
+                teacher_log_probs = teacher(teacher_x[start:start + chunk_size])
+            if torch.is_grad_enabled():
+                total = total + checkpoint(self._chunk_distillation_loss, chunk_x, teacher_log_probs, chunk_label, alpha, temperature, label_smoothing, use_reentrant=False)
+            else:
+                total = total + self._chunk_distillation_loss(chunk_x, teacher_log_probs, chunk_label, alpha, temperature, label_smoothing)
+        return total / max(label.shape[0], 1)
 
 class Transformer(nn.Module):
     # src_pos = tgt_pos
@@ -196,23 +487,87 @@ class Transformer(nn.Module):
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
     
-    def encode(self, src, src_mask):
+    def encode(self, src, src_mask, positions=None):
         # (batch, seq_len, d_model)
         src = self.src_embed(src)
-        src = self.src_pos(src)
+        src = self.src_pos(src, positions=positions)
         return self.encoder(src, src_mask)
     
-    def decode(self, encoder_output, src_mask, tgt, tgt_mask):
+    def set_attention_backend(self, backend: str):
+        # 'math', 'sdpa' or 'chunked', see MultiHeadAttentionBlock
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttentionBlock):
+                module.backend = backend
+    
+    def capture_attention_scores(self, enabled: bool = True):
+        # keep the attention scores of every block (in attention_scores) to visualize them
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttentionBlock):
+                module.capture_scores = enabled
+                if not enabled:
+                    module.attention_scores = None
+    
+    def set_activation_checkpointing(self, enabled: bool = True):
+        # per block activation checkpointing in the encoder and the decoder
+        self.encoder.activation_checkpointing = enabled
+        self.decoder.activation_checkpointing = enabled
+    
+    def init_kv_cache(self):
+        # one empty self-attention cache per decoder layer, filled in by decode()
+        return [{} for _ in self.decoder.layers]
+    
+    def reorder_kv_cache(self, kv_caches, index):
+        # keep (and reorder) only the batch rows in index, e.g. drop finished sentences or follow beam parents
+        for kv_cache in kv_caches:
+            for name in kv_cache:
+                kv_cache[name] = kv_cache[name].index_select(0, index)
+    
+    def precompute_memory(self, encoder_output):
+        # Project the encoder output into the cross attention keys/values of every decoder layer once,
+        # then pass the result to decode() at every step (and share it between beam hypotheses)
+        return self.decoder.precompute_memory(encoder_output)
+    
+    def decode(self, encoder_output, src_mask, tgt, tgt_mask, kv_caches=None, memory_kvs=None, positions=None):
+        # With kv_caches, tgt only holds the new tokens, the earlier ones are already in the caches
+        start_pos = kv_caches[0]['key'].shape[2] if kv_caches is not None and 'key' in kv_caches[0] else 0
         # (batch, seq_len, d_model)
         tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        tgt = self.tgt_pos(tgt, start_pos, positions)
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, kv_caches, memory_kvs)
     
-    def project(self, x):
+    def forward(self, src, src_mask, tgt, tgt_mask, cross_mask=None, src_positions=None, tgt_positions=None):
+        # Training pass up to the decoder output (the projection is applied by the loss),
+        # it goes through forward() so that DistributedDataParallel can wrap the model.
+        # cross_mask defaults to src_mask, packed rows need their own (see SegmentMask)
+        encoder_output = self.encode(src, src_mask, src_positions) # (batch, seq_len, d_model)
+        cross_mask = src_mask if cross_mask is None else cross_mask
+        return self.decode(encoder_output, cross_mask, tgt, tgt_mask, positions=tgt_positions) # (batch, seq_len, d_model)
+    
+    def project(self, x, shortlist=None):
         # (batch, seq_len, vocab_size)
-        return self.projection_layer(x)
+        return self.projection_layer(x, shortlist)
+
+def fuse_transformer(model: nn.Module) -> nn.Module:
+    # Swap (in place) every MultiHeadAttentionBlock for a FusedMultiHeadAttentionBlock and every
+    # LayerNormalisation for a FusedLayerNormalisation, keeping the trained weights
+    for name, child in model.named_children():
+        if isinstance(child, MultiHeadAttentionBlock) and not isinstance(child, FusedMultiHeadAttentionBlock):
+            fused = FusedMultiHeadAttentionBlock(child.d_model, child.h, child.dropout.p)
+            fused.backend, fused.chunk_size, fused.capture_scores = child.backend, child.chunk_size, child.capture_scores
+        elif isinstance(child, LayerNormalisation) and not isinstance(child, FusedLayerNormalisation):
+            fused = FusedLayerNormalisation(child.alpha.shape[0], child.eps)
+        else:
+            fuse_transformer(child)
+            continue
+        fused.load_state_dict(child.state_dict())
+        fused.to(child.w_o.weight if isinstance(child, MultiHeadAttentionBlock) else child.alpha)
+        fused.train(child.training)
+        setattr(model, name, fused)
+    return model
+
+def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model = 512, N: int = 6, h: int = 8, dropout = 0.1, d_ff: int = 2048, fused: bool = False, N_dec: int = None) -> Transformer:
+    # N encoder layers and N_dec (default N) decoder layers, a deep encoder with a shallow decoder decodes faster
 
-def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model = 512, N: int = 6, h: int = 8, dropout = 0.1, d_ff: int = 2048) -> Transformer:
     # Create the embedding layers
     src_embed = InputEmbeddings(d_model, src_vocab_size)
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
@@ -231,7 +586,7 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     
     # Create the decoder blocks
     decoder_blocks = []
-    for _ in range(N):
+    for _ in range(N if N_dec is None else N_dec):
         decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
         decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
@@ -253,4 +608,8 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
         if p.dim() > 1:
             nn.init.xavier_uniform_(p)
     
+    # Fused QKV projection and normalisation, loads the same checkpoints
+    if fused:
+        fuse_transformer(transformer)
+    
     return transformer
\ No newline at end of file
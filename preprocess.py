@@ -0,0 +1,22 @@
+from datasets import load_dataset
+
+from config import get_config
+from train import get_or_build_tokenizer, get_or_build_token_cache
+
+# Offline preprocessing: build the tokenizers and tokenize the whole split once,
+# get_ds then serves the samples from the memory-mapped cache
+def preprocess(config):
+    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+
+    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+
+    cache_dir, meta = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt)
+    print(f'Token cache for {meta["num_pairs"]} sentence pairs in {cache_dir}')
+    print(f'Max length of source sentence: {meta["max_len_src"]}')
+    print(f'Max length of target sentence: {meta["max_len_tgt"]}')
+
+
+if __name__ == '__main__':
+    config = get_config()
+    preprocess(config)
@@ -0,0 +1,80 @@
+import time
+import threading
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+# Instrumentation of the training loop: per phase wall clock timers, a metrics buffer that is written
+# to TensorBoard from a background thread, and optional torch.profiler trace windows
+
+class PhaseTimer:
+    # Lap timer: lap(name) adds the time since the previous lap to name. CUDA kernels run asynchronously,
+    # so on a GPU the device is synchronized first, otherwise the time would land in a later phase
+
+    def __init__(self, device) -> None:
+        self.device = torch.device(device)
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def reset(self):
+        totals, self.totals = self.totals, {}
+        self.last = time.perf_counter()
+        return totals
+
+class MetricsBuffer:
+    # add_scalar() only appends to a list and accepts tensors, so logging the loss doesn't force a
+    # device sync. flush() turns the buffered tensors into numbers at once and hands the writing to a thread
+
+    def __init__(self, writer) -> None:
+        self.writer = writer
+        self.scalars = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def add_scalar(self, tag, value, step):
+        self.scalars.append((tag, value.detach() if isinstance(value, torch.Tensor) else value, step))
+
+    def flush(self):
+        scalars, self.scalars = self.scalars, []
+        scalars = [(tag, float(value), step) for tag, value, step in scalars]
+        # at most one write in flight, a slow disk slows the training down instead of growing the buffer
+        self.wait()
+        with self.lock:
+            self.pending = self.executor.submit(self._write, scalars)
+
+    def _write(self, scalars):
+        for tag, value, step in scalars:
+            self.writer.add_scalar(tag, value, step)
+        self.writer.flush()
+
+    def wait(self):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.result()
+
+    def close(self):
+        self.flush()
+        self.wait()
+        self.executor.shutdown()
+
+def trace_profiler(profile_steps, folder):
+    # profile_steps = [start, end]: trace the training iterations start..end-1 (counted from the first
+    # iteration of this run) into a TensorBoard trace. prof.step() has to be called once per iteration
+    if not profile_steps:
+        return None
+    start, end = profile_steps
+    return torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+        schedule=torch.profiler.schedule(wait=max(0, start - 1), warmup=min(1, start), active=end - start, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(folder),
+        record_shapes=True,
+        profile_memory=True,
+    )
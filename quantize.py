@@ -0,0 +1,86 @@
+import io
+import time
+import torch
+import torch.nn as nn
+from pathlib import Path
+
+import torchmetrics
+
+from train import get_model
+from checkpointing import load_checkpoint
+from config import get_config, latest_weights_file_path, get_quantized_weights_file_path
+
+# Dynamic int8 quantization for CPU inference: the weights of every nn.Linear (attention projections,
+# FeedForwardBlock and ProjectionLayer) are stored as int8, the activations are quantized on the fly
+
+def quantize_model(model):
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def get_quantizable_model(config, vocab_src_len, vocab_tgt_len):
+    # the fused variant slices the packed QKV weight directly, which a quantized Linear doesn't support
+    return get_model(dict(config, fused=False), vocab_src_len, vocab_tgt_len)
+
+def save_quantized_model(model, weights_file, quantized_file):
+    Path(quantized_file).parent.mkdir(parents=True, exist_ok=True)
+    torch.save({
+        'source_weights_file': str(weights_file),
+        'model_state_dict': model.state_dict(),
+    }, quantized_file)
+
+def load_quantized_model(config, quantized_file, vocab_src_len, vocab_tgt_len):
+    # the quantized modules have to exist before their state can be loaded
+    model = quantize_model(get_quantizable_model(config, vocab_src_len, vocab_tgt_len))
+    state = torch.load(quantized_file, map_location='cpu')
+    model.load_state_dict(state['model_state_dict'])
+    return model.eval()
+
+def quantize_checkpoint(config, weights_file, vocab_src_len, vocab_tgt_len):
+    model = get_quantizable_model(config, vocab_src_len, vocab_tgt_len)
+    state = load_checkpoint(weights_file)
+    model.load_state_dict(state['model_state_dict'])
+    quantized_file = get_quantized_weights_file_path(config, weights_file)
+    save_quantized_model(quantize_model(model), weights_file, quantized_file)
+    return quantized_file
+
+def state_dict_bytes(model):
+    # serialized size of the weights alone (a training checkpoint also holds the optimizer state)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def timed_translate(translator, texts, batch_size):
+    start = time.perf_counter()
+    translations = []
+    for i in range(0, len(texts), batch_size):
+        translations.extend(translator.translate_batch(texts[i:i + batch_size]))
+    return translations, time.perf_counter() - start
+
+def report(config, num_sentences: int = 200):
+    # the translators import this module to load int8 checkpoints
+    from translate import Translator, uncached_config, validation_sources
+
+    weights_file = latest_weights_file_path(config)
+    config = uncached_config(config)
+    fp32 = Translator(config, weights_file, quantized=False)
+    quantized_file = quantize_checkpoint(config, weights_file, fp32.tokenizer_src.get_vocab_size(), fp32.tokenizer_tgt.get_vocab_size())
+    int8 = Translator(config, quantized_file, quantized=True)
+
+    sources, targets = validation_sources(config, num_sentences)
+
+    fp32_out, fp32_time = timed_translate(fp32, sources, config['val_batch_size'])
+    int8_out, int8_time = timed_translate(int8, sources, config['val_batch_size'])
+
+    bleu = torchmetrics.BLEUScore()
+    print(f"Sentences:              {len(sources)}")
+    fp32_bytes, int8_bytes = state_dict_bytes(fp32.model), state_dict_bytes(int8.model)
+    print(f"Model size fp32 / int8: {fp32_bytes / 1024 ** 2:.1f} / {int8_bytes / 1024 ** 2:.1f} MB ({fp32_bytes / int8_bytes:.2f}x)")
+    print(f"Latency fp32 / int8:    {1000 * fp32_time / len(sources):.1f} / {1000 * int8_time / len(sources):.1f} ms per sentence ({fp32_time / int8_time:.2f}x)")
+    print(f"Identical translations: {sum(a == b for a, b in zip(fp32_out, int8_out)) / len(sources):.1%}")
+    print(f"BLEU int8 vs fp32:      {float(bleu(int8_out, [[x] for x in fp32_out])):.4f}")
+    print(f"BLEU fp32 / int8 vs reference: {float(bleu(fp32_out, [[x] for x in targets])):.4f} / {float(bleu(int8_out, [[x] for x in targets])):.4f}")
+
+
+if __name__ == '__main__':
+    config = get_config()
+    report(config)
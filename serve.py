@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_config
+from translate import Translator
+
+# Local HTTP/JSON translation service.
+#   POST /translate {"text": "..."} -> {"translation": "...", "queue_ms": ..., "compute_ms": ..., "batch_size": ...}
+#   GET /stats -> request count, latency percentiles and cache hit/miss counts
+# Requests are queued and grouped into micro-batches: a batch is closed when it holds max_batch_size
+# requests or max_wait_ms after its first request arrived. The batch runs in a worker thread so the
+# event loop keeps accepting requests while the model is busy
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class MicroBatcher:
+    def __init__(self, translator: Translator, max_batch_size: int, max_wait_ms: float) -> None:
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # one worker: the batches run one after the other, torch uses the cores inside each batch
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # (queue_ms, compute_ms, total_ms) of the most recent requests
+        self.latencies = []
+        self.max_latencies = 10000
+        self.num_batches = 0
+
+    async def translate(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # everything that queued up while the previous batch was running goes in first,
+            # the deadline only bounds how long to wait for more
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                translations = await loop.run_in_executor(self.executor, self.translator.translate_batch, [text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            self.num_batches += 1
+
+            for (_, future, enqueued), translation in zip(batch, translations):
+                queue_ms = (start - enqueued) * 1000
+                compute_ms = (end - start) * 1000
+                self.latencies.append((queue_ms, compute_ms, queue_ms + compute_ms))
+                if not future.done():
+                    future.set_result({"translation": translation, "queue_ms": round(queue_ms, 3), "compute_ms": round(compute_ms, 3), "batch_size": len(batch)})
+            del self.latencies[:-self.max_latencies]
+
+    def stats(self):
+        queue_ms, compute_ms, total_ms = (list(x) for x in zip(*self.latencies)) if self.latencies else ([], [], [])
+        return {
+            "requests": len(total_ms),
+            "batches": self.num_batches,
+            "queue_ms": {"p50": percentile(queue_ms, 0.5), "p99": percentile(queue_ms, 0.99)},
+            "compute_ms": {"p50": percentile(compute_ms, 0.5), "p99": percentile(compute_ms, 0.99)},
+            "total_ms": {"p50": percentile(total_ms, 0.5), "p99": percentile(total_ms, 0.99)},
+            **self.translator.cache_stats(),
+        }
+
+# raises ValueError for a malformed request line, header or Content-Length
+async def read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if not request_line:
+        return None
+    method, path, _ = request_line.split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+def write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+
+def make_handler(batcher: MicroBatcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except ValueError:
+                    # the rest of the stream can't be framed, answer and close the connection
+                    write_response(writer, 400, {"error": "malformed HTTP request"})
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method == 'POST' and path == '/translate':
+                    try:
+                        text = json.loads(body)['text']
+                        # anything but a string would only fail in the worker, with the rest of its micro-batch
+                        if not isinstance(text, str):
+                            raise TypeError(f"text must be a string, not {type(text).__name__}")
+                    except (ValueError, KeyError, TypeError):
+                        write_response(writer, 400, {"error": 'expected a JSON body {"text": "..."}'})
+                    else:
+                        try:
+                            write_response(writer, 200, await batcher.translate(text))
+                        except Exception as e:
+                            write_response(writer, 500, {"error": str(e)})
+                elif method == 'GET' and path == '/stats':
+                    write_response(writer, 200, batcher.stats())
+                else:
+                    write_response(writer, 404, {"error": "not found"})
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+async def serve(config):
+    translator = Translator(config)
+    print(f"Loaded {translator.weights_file}")
+    batcher = MicroBatcher(translator, config['serve_max_batch_size'], config['serve_max_wait_ms'])
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher), config['serve_host'], config['serve_port'])
+    print(f"Serving on http://{config['serve_host']}:{config['serve_port']}")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+if __name__ == '__main__':
+    config = get_config()
+    asyncio.run(serve(config))
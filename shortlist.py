@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+from pathlib import Path
+from datasets import load_dataset
+
+import torchmetrics
+
+from dataset import TokenizedBilingualDataset
+from train import get_or_build_tokenizer, get_or_build_token_cache, split_ds
+from quantize import timed_translate
+from config import get_config, get_shortlist_path
+
+# Vocabulary shortlist for greedy decoding: the output projection only scores the target tokens that are
+# likely for the source sentences of the batch. The candidates of every source token come from a lexical
+# table built once from the training pairs; the most frequent target tokens and the special tokens are
+# always included
+
+def build_lexical_table(token_ds, indices, src_vocab_size: int, tgt_vocab_size: int, top_k: int, num_frequent: int, special_ids, chunk_size: int = 1024):
+    # Sentence level co-occurrence counts of every (source token, target token) pair. A pair is scored with
+    # the Dice coefficient 2 c(s, t) / (c(s) + c(t)), so that frequent target words don't end up as the
+    # candidates of every source token (they are in the always included list anyway)
+    src_count = np.zeros(src_vocab_size, dtype=np.int64)
+    tgt_count = np.zeros(tgt_vocab_size, dtype=np.int64)
+    tgt_tokens = np.zeros(tgt_vocab_size, dtype=np.int64)
+    pair_keys, pair_counts = [], []
+    keys = []
+    for n, idx in enumerate(indices):
+        src = np.unique(token_ds.src_ids(idx).numpy()).astype(np.int64)
+        tgt_ids = token_ds.tgt_ids(idx).numpy()
+        tgt = np.unique(tgt_ids).astype(np.int64)
+        src_count[src] += 1
+        tgt_count[tgt] += 1
+        np.add.at(tgt_tokens, tgt_ids, 1)
+        # pair (s, t) as the single key s * tgt_vocab_size + t
+        keys.append((src[:, None] * tgt_vocab_size + tgt[None, :]).ravel())
+        if (n + 1) % chunk_size == 0 or n + 1 == len(indices):
+            # reduce every chunk of sentences right away, the raw pairs would take a lot of memory
+            chunk_keys, chunk_counts = np.unique(np.concatenate(keys), return_counts=True)
+            pair_keys.append(chunk_keys)
+            pair_counts.append(chunk_counts)
+            keys = []
+    pair_keys, inverse = np.unique(np.concatenate(pair_keys), return_inverse=True)
+    pair_counts = np.bincount(inverse, weights=np.concatenate(pair_counts))
+
+    src_ids, tgt_ids = pair_keys // tgt_vocab_size, pair_keys % tgt_vocab_size
+    score = 2 * pair_counts / (src_count[src_ids] + tgt_count[tgt_ids])
+    # best top_k target tokens of every source token: sort by source token, then by descending score
+    order = np.lexsort((-score, src_ids))
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    starts = np.searchsorted(src_ids, np.arange(src_vocab_size))
+    rank = np.arange(len(src_ids)) - starts[src_ids]
+    keep = rank < top_k
+    # unused slots hold the first special token, which is always part of the shortlist
+    candidates = np.full((src_vocab_size, top_k), special_ids[0], dtype=np.int64)
+    candidates[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+    always = np.union1d(np.argsort(-tgt_tokens, kind='stable')[:num_frequent], np.asarray(special_ids, dtype=np.int64))
+    return torch.from_numpy(candidates), torch.from_numpy(always)
+
+def get_or_build_shortlist(config):
+    path = Path(get_shortlist_path(config))
+    if not path.exists():
+        ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+        tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+        tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+        # only the training pairs, so that the validation sentences measure the shortlist honestly
+        train_ds_raw, _ = split_ds(config, ds_raw)
+        cache_dir, _ = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt)
+        token_ds = TokenizedBilingualDataset(cache_dir, tokenizer_tgt, config['seq_len'])
+        special_ids = [tokenizer_tgt.token_to_id(token) for token in ('[PAD]', '[UNK]', '[SOS]', '[EOS]')]
+        candidates, always = build_lexical_table(token_ds, train_ds_raw.indices, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(), config['shortlist_top_k'], config['shortlist_frequent'], special_ids)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save({'candidates': candidates, 'always': always}, path)
+    return VocabShortlist.load(path)
+
+class VocabShortlist:
+    # Maps a batch of source token ids to the sorted target ids the output projection is restricted to
+
+    def __init__(self, candidates: torch.Tensor, always: torch.Tensor) -> None:
+        self.candidates = candidates # (src_vocab_size, top_k)
+        self.always = always
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path, map_location='cpu')
+        return cls(state['candidates'], state['always'])
+
+    def __call__(self, source):
+        # (b, src_len) -> (shortlist_size) sorted, the candidates of [PAD] are harmless
+        vocab = torch.cat([self.candidates[source.cpu()].flatten(), self.always])
+        return torch.unique(vocab).to(source.device)
+
+def report(config, num_sentences: int = 200):
+    # the translators import this module to load the shortlist
+    from translate import Translator, uncached_config, validation_sources
+
+    get_or_build_shortlist(config)
+    # the shortlist is only used by greedy decoding
+    config = dict(uncached_config(config), beam_size=1)
+    full = Translator(dict(config, vocab_shortlist=False))
+    shortlisted = Translator(dict(config, vocab_shortlist=True))
+
+    sources, _ = validation_sources(config, num_sentences)
+
+    full_out, full_time = timed_translate(full, sources, config['val_batch_size'])
+    shortlist_out, shortlist_time = timed_translate(shortlisted, sources, config['val_batch_size'])
+    sizes = [len(shortlisted.shortlist(shortlisted.encode_sources(shortlisted.tokenize([text]))[0])) for text in sources]
+
+    bleu = torchmetrics.BLEUScore()
+    print(f"Sentences:              {len(sources)}")
+    print(f"Output vocabulary:      {full.tokenizer_tgt.get_vocab_size()} full / {sum(sizes) / len(sizes):.0f} shortlist (mean per sentence)")
+    print(f"Latency full / short:   {1000 * full_time / len(sources):.1f} / {1000 * shortlist_time / len(sources):.1f} ms per sentence ({full_time / shortlist_time:.2f}x)")
+    print(f"Identical translations: {sum(a == b for a, b in zip(full_out, shortlist_out)) / len(sources):.1%}")
+    print(f"BLEU shortlist vs full: {float(bleu(shortlist_out, [[x] for x in full_out])):.4f}")
+
+
+if __name__ == '__main__':
+    report(get_config())
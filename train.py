@@ -1,17 +1,26 @@
 import torchtext.datasets as datasets
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, Subset, random_split
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
 from torch.optim.lr_scheduler import LambdaLR
 
 import warnings
+import hashlib
 from tqdm import tqdm
 import os
+import time
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
 
-from dataset import BilingualDataset, causal_mask
+from dataset import BilingualDataset, TokenizedBilingualDataset, PackedBilingualDataset, BucketBatchSampler, build_token_cache, load_token_cache_meta, token_cache_key, collate_batch, causal_mask
 from model import build_transformer
-from config import get_weights_file_path, get_config, latest_weights_file_path
+from config import get_weights_file_path, get_config, latest_weights_file_path, get_token_cache_path
+from checkpointing import AsyncCheckpointer, load_checkpoint, remap_optimizer_state
+from profiler import PhaseTimer, MetricsBuffer, trace_profiler
 
 # Huggingface datasets and tokenizers
 from datasets import load_dataset
@@ -23,23 +32,30 @@ from tokenizers.pre_tokenizers import Whitespace
 import torchmetrics
 from torch.utils.tensorboard import SummaryWriter
 
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device):
+def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, use_kv_cache=True):
     sos_idx = tokenizer_tgt.token_to_id('[SOS]')
     eos_idx = tokenizer_tgt.token_to_id('[EOS]')
 
     # Precompute the encoder output and reuse it for every step
     encoder_output = model.encode(source, source_mask)
+    # Keys/values of the already decoded tokens, so each step only runs the newest token through the decoder
+    kv_caches = model.init_kv_cache() if use_kv_cache else None
+    # Cross attention keys/values only depend on the encoder output, project them once
+    memory_kvs = model.precompute_memory(encoder_output)
     # Initialize the decoder input with the sos token
     decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(device)
     while True:
         if decoder_input.size(1) == max_len:
             break
 
-        # build mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-
         # calculate output
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
+        if kv_caches is not None:
+            # a single new token may look at every cached position, so no target mask is needed
+            out = model.decode(encoder_output, source_mask, decoder_input[:, -1:], None, kv_caches, memory_kvs)
+        else:
+            # build mask for target
+            decoder_mask = causal_mask(decoder_input.size(1)).to(device)
+            out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask, memory_kvs=memory_kvs)
 
         # get next token
         prob = model.project(out[:, -1])
@@ -54,7 +70,115 @@ def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_
 
     return decoder_input.squeeze(0) # removes the batch dimension
 
-def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples=2):
+def batch_greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, encoder_output=None, vocab=None):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    # Precompute the encoder output (unless given) and the cross attention keys/values, reused for every step
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask) # (b, seq_len, d_model)
+    memory_kvs = model.precompute_memory(encoder_output)
+    kv_caches = model.init_kv_cache()
+    # vocab: sorted target ids the output is restricted to (see shortlist.py), the projection only computes those
+    shortlist = model.projection_layer.select(vocab) if vocab is not None else None
+
+    # (b, max_len) every sentence starts with sos, everything after its eos stays padding
+    decoder_output = torch.full((batch_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    decoder_output[:, 0] = sos_idx
+    # rows of decoder_output that are still being decoded, the batch shrinks as sentences finish
+    active = torch.arange(batch_size, device=device)
+    next_word = decoder_output[:, 0]
+    for step in range(1, max_len):
+        out = model.decode(encoder_output, source_mask, next_word.unsqueeze(1), None, kv_caches, memory_kvs)
+
+        # select token with max probability for every unfinished sentence
+        prob = model.project(out[:, -1], shortlist)
+        next_word = prob.argmax(dim=-1) # (active,)
+        if vocab is not None:
+            next_word = vocab[next_word]
+        decoder_output[active, step] = next_word
+
+        # drop the sentences that just produced eos from every per-sentence tensor
+        unfinished = next_word != eos_idx
+        if not unfinished.all():
+            if not unfinished.any():
+                break
+            keep = unfinished.nonzero().squeeze(1)
+            active = active[keep]
+            next_word = next_word[keep]
+            encoder_output = encoder_output[keep]
+            source_mask = source_mask[keep]
+            memory_kvs = [(key[keep], value[keep]) for key, value in memory_kvs]
+            model.reorder_kv_cache(kv_caches, keep)
+
+    return decoder_output # (b, max_len)
+
+def beam_search_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, beam_size=4, length_penalty=0.6, encoder_output=None):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    # The encoder output and the cross attention keys/values are computed once per sentence (not per beam),
+    # the attention block shares them between the beams of a sentence
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask) # (b, seq_len, d_model)
+    memory_kvs = model.precompute_memory(encoder_output)
+    # the self attention caches hold one row per hypothesis: (b * beam_size, h, step, d_k)
+    kv_caches = model.init_kv_cache()
+
+    # all the hypotheses of all the sentences live in one (b * beam_size, max_len) tensor
+    tokens = torch.full((batch_size * beam_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    tokens[:, 0] = sos_idx
+    # only the first beam is alive at the start, otherwise every beam would pick the same tokens
+    scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=device)
+    lengths = torch.zeros(batch_size * beam_size, device=device)
+    # index of the first beam of every sentence in the flat (b * beam_size) layout
+    beam_offset = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1) # (b, 1)
+
+    next_word = tokens[:, 0]
+    for step in range(1, max_len):
+        out = model.decode(encoder_output, source_mask, next_word.unsqueeze(1), None, kv_caches, memory_kvs)
+        log_probs = model.project(out[:, -1]) # (b * beam_size, vocab_size)
+        vocab_size = log_probs.size(-1)
+
+        # a finished hypothesis can only be extended with padding, which keeps its score unchanged
+        pad_only = torch.full_like(log_probs[:1], float('-inf'))
+        pad_only[:, pad_idx] = 0.0
+        log_probs = torch.where(finished.unsqueeze(1), pad_only, log_probs)
+
+        # pick the best beam_size extensions of every sentence among all its beams
+        candidates = (scores.view(-1, 1) + log_probs).view(batch_size, -1) # (b, beam_size * vocab_size)
+        scores, flat_index = candidates.topk(beam_size, dim=1) # (b, beam_size)
+        parent = torch.div(flat_index, vocab_size, rounding_mode='floor') + beam_offset
+        parent = parent.view(-1) # (b * beam_size)
+        next_word = (flat_index % vocab_size).view(-1)
+
+        # follow the parents of the surviving hypotheses
+        tokens = tokens[parent]
+        tokens[:, step] = next_word
+        was_finished = finished[parent]
+        lengths = lengths[parent] + (~was_finished).float()
+        finished = was_finished | (next_word == eos_idx)
+        model.reorder_kv_cache(kv_caches, parent)
+
+        if finished.all():
+            break
+
+    # length normalization (Wu et al. 2016) so that short hypotheses are not always preferred
+    penalty = ((5.0 + lengths) / 6.0).pow(length_penalty).view(batch_size, beam_size)
+    best = (scores / penalty).argmax(dim=1, keepdim=True) + beam_offset
+    return tokens[best.view(-1)] # (b, max_len)
+
+def autocast(config, device):
+    # bfloat16 mixed precision when config['bf16'] is set, LayerNormalisation, softmax and log_softmax stay in fp32
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=config['bf16'])
+
+def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples=2, beam_size=1, bf16=False):
     model.eval()
     
     count = 0
@@ -73,28 +197,34 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
 
     with torch.no_grad():
         for batch in validation_ds:
-            count += 1
             encoder_input = batch["encoder_input"].to(device) # (b, seq_len)
-            encoder_mask = batch["encoder_mask"].to(device) # (b, 1, 1, seq_len)
-            
-            # check that the batch size is 1
-            assert encoder_input.size(0) == 1, "Batch size must be 1 for validation"
+            encoder_mask = batch["encoder_mask"].to(device) # LengthMask, (b) source lengths
             
-            model_out = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
-
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
+            # translate the whole batch at once
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                if beam_size > 1:
+                    model_out = beam_search_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device, beam_size)
+                else:
+                    model_out = batch_greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
+
+            for i in range(encoder_input.size(0)):
+                count += 1
+                source_text = batch["src_text"][i]
+                target_text = batch["tgt_text"][i]
+                model_out_text = tokenizer_tgt.decode(model_out[i].detach().cpu().numpy())
+
+                source_texts.append(source_text)
+                expected.append(target_text)
+                predicted.append(model_out_text)
+                
+                # Print the source, target and model output
+                print_msg('-'*console_width)
+                print_msg(f"{f'SOURCE: ':>12}{source_text}")
+                print_msg(f"{f'TARGET: ':>12}{target_text}")
+                print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
 
-            source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-            
-            # Print the source, target and model output
-            print_msg('-'*console_width)
-            print_msg(f"{f'SOURCE: ':>12}{source_text}")
-            print_msg(f"{f'TARGET: ':>12}{target_text}")
-            print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
+                if count == num_examples:
+                    break
 
             if count == num_examples:
                 print_msg('-'*console_width)
@@ -138,67 +268,184 @@ def get_or_build_tokenizer(config, ds, lang):
         tokenizer = Tokenizer.from_file(str(tokenizer_path))
     return tokenizer
 
-def get_ds(config):
-    # It only has the train split, so we divide it overselves
-    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
-
-    # Build tokenizers
-    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
-    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+def get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt):
+    cache_dir = str(Path(get_token_cache_path(config)) / token_cache_key(ds_raw, tokenizer_src, tokenizer_tgt))
+    meta = load_token_cache_meta(cache_dir)
+    if meta is None:
+        meta = build_token_cache(ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], cache_dir)
+    return cache_dir, meta
 
+def split_ds(config, ds_raw):
     # Keep 90% for training, 10% for validation
     train_ds_size = int(0.9 * len(ds_raw))
     val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
-
-    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    # seeded so that every process of a distributed run gets the same split
+    return random_split(ds_raw, [train_ds_size, val_ds_size], generator=torch.Generator().manual_seed(config['seed']))
 
-    # Find the maximum length of each sentence in the source and target sentence
-    max_len_src = 0
-    max_len_tgt = 0
+def get_ds(config, rank=0, world_size=1):
+    # It only has the train split, so we divide it overselves
+    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    # Build tokenizers
+    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
 
-    print(f'Max length of source sentence: {max_len_src}')
-    print(f'Max length of target sentence: {max_len_tgt}')
+    train_ds_raw, val_ds_raw = split_ds(config, ds_raw)
+
+    # Tokenize the whole corpus once (cached on disk, keyed by dataset and tokenizers) and read the length statistics
+    cache_dir, meta = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt)
+    if config['distilled_targets']:
+        # sequence-level distillation: the training targets are the teacher's translations (see distill.py)
+        assert config['use_token_cache'], "Distilled targets need the token cache (use_token_cache)"
+        cache_dir, meta = config['distilled_targets'], load_token_cache_meta(config['distilled_targets'])
+    token_ds = TokenizedBilingualDataset(cache_dir, tokenizer_tgt, config['seq_len'])
+
+    if config['use_token_cache']:
+        # Serve the samples from the pre-tokenized, memory-mapped cache
+        # the training samples don't need the raw text, only validation prints it
+        if config['pack_sequences']:
+            # several sentence pairs per seq_len row
+            train_ds = PackedBilingualDataset(token_ds, train_ds_raw.indices, config['seq_len'], seed=config['seed'])
+        else:
+            train_ds = Subset(token_ds, train_ds_raw.indices)
+        val_ds = Subset(TokenizedBilingualDataset(cache_dir, tokenizer_tgt, config['seq_len'], ds_raw, config['lang_src'], config['lang_tgt']), val_ds_raw.indices)
+    else:
+        assert not config['pack_sequences'], "Sequence packing needs the token cache (use_token_cache)"
+        train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+        val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+
+    # Maximum length of each sentence in the source and target sentence
+    if rank == 0:
+        print(f'Max length of source sentence: {meta["max_len_src"]}')
+        print(f'Max length of target sentence: {meta["max_len_tgt"]}')
     
-
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # padded-free length of every sample, used to bucket sentences of similar length
+    lengths = token_ds.lengths()
+
+    # pad every batch only up to its longest sentence
+    collate_fn = partial(collate_batch, pad_token=tokenizer_tgt.token_to_id('[PAD]'))
+    # the loader workers read the memory-mapped token cache, they share its pages instead of copying the corpus
+    loader_kwargs = dict(collate_fn=collate_fn, num_workers=config['num_workers'], persistent_workers=config['persistent_workers'] and config['num_workers'] > 0)
+    if config['max_tokens']:
+        # batches of similar length sentences holding at most max_tokens tokens, instead of batch_size sentences
+        train_lengths = train_ds.lengths() if config['pack_sequences'] else [lengths[i] for i in train_ds_raw.indices]
+        batch_sampler = BucketBatchSampler(train_lengths, config['max_tokens'], num_replicas=world_size, rank=rank, seed=config['seed'])
+        train_dataloader = DataLoader(train_ds, batch_sampler=batch_sampler, **loader_kwargs)
+    elif world_size > 1:
+        # every process trains on its own shard of the training set
+        sampler = DistributedSampler(train_ds, num_replicas=world_size, rank=rank, shuffle=True, seed=config['seed'])
+        train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], sampler=sampler, **loader_kwargs)
+    else:
+        train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True, **loader_kwargs)
+    val_dataloader = DataLoader(val_ds, batch_size=config['val_batch_size'], shuffle=True, **loader_kwargs)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
 def get_model(config, vocab_src_len, vocab_tgt_len):
-    model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config['seq_len'], d_model=config['d_model'])
+    model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config['seq_len'], d_model=config['d_model'], N=config['N'], h=config['h'], d_ff=config['d_ff'], fused=config['fused'], N_dec=config['N_dec'])
+    model.set_attention_backend(config['attention_backend'])
+    model.set_activation_checkpointing(config['activation_checkpointing'])
     return model
 
-def train_model(config):
+def compute_loss(config, model, batch, device, loss_fn, pad_idx, vocab_size, teacher=None):
+    encoder_input = batch['encoder_input'].to(device) # (batch, seq_len)
+    decoder_input = batch['decoder_input'].to(device) # (Batch, seq_len)
+    encoder_mask = batch['encoder_mask'].to(device) # LengthMask (batch) hide only [PAD] tokens
+    decoder_mask = batch['decoder_mask'].to(device) # causal LengthMask (Batch) hide [PAD] and subsequent tokens
+    # packed rows: block diagonal cross attention mask and positions restarting for every pair
+    cross_mask = batch['cross_mask'].to(device) if 'cross_mask' in batch else None
+    encoder_positions = batch['encoder_positions'].to(device) if 'encoder_positions' in batch else None
+    decoder_positions = batch['decoder_positions'].to(device) if 'decoder_positions' in batch else None
+
+    # model may be wrapped in DistributedDataParallel, the projection is called on the Transformer itself
+    transformer = model.module if isinstance(model, DistributedDataParallel) else model
+
+    with autocast(config, device):
+        # Run the tensors through the encoder, decoder and the projection layer
+        decoder_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask, cross_mask, encoder_positions, decoder_positions) # (B, seq_len, d_model)
+
+        # Compare the output with the label
+        label = batch['label'].to(device) # (Batch, seq_len)
+
+        if teacher is not None:
+            # knowledge distillation: hard labels plus the soft targets of the teacher on the same batch
+            with torch.no_grad():
+                teacher_output = teacher(encoder_input, encoder_mask, decoder_input, decoder_mask, cross_mask, encoder_positions, decoder_positions)
+            return transformer.projection_layer.chunked_distillation_loss(decoder_output, teacher.projection_layer, teacher_output, label, pad_idx, config['distill_alpha'], config['distill_temperature'], label_smoothing=0.1, chunk_size=config['loss_chunk_size'] or label.numel())
+        if config['loss_chunk_size']:
+            # projection + cross entropy on the non [PAD] positions only, chunk by chunk
+            return transformer.projection_layer.chunked_loss(decoder_output, label, pad_idx, label_smoothing=0.1, chunk_size=config['loss_chunk_size'])
+        proj_output = transformer.project(decoder_output) # (B, seq_len, vocab_size)
+
+        # Compute the loss using a simple cross entropy
+        # (batch, seq_len, tgt_vocab_size) -> (batch * seq_len, tgt_vocab_size)
+        return loss_fn(proj_output.view(-1, vocab_size), label.view(-1))
+
+def measure_bf16_speedup(config, model, batch, device, loss_fn, pad_idx, vocab_size, steps=3):
+    # time forward + backward of the same batch in fp32 and in bf16, the gradients are thrown away
+    timings = {}
+    for bf16 in (False, True):
+        step_config = dict(config, bf16=bf16)
+        compute_loss(step_config, model, batch, device, loss_fn, pad_idx, vocab_size).backward() # warm up
+        start = time.perf_counter()
+        for _ in range(steps):
+            compute_loss(step_config, model, batch, device, loss_fn, pad_idx, vocab_size).backward()
+        timings[bf16] = (time.perf_counter() - start) / steps
+    model.zero_grad(set_to_none=True)
+    return timings[False] / timings[True]
+
+def train_model(config, teacher=None):
+    # Distributed data parallel training when started by launch.py (or torchrun): one process per shard,
+    # gradients are all-reduced over gloo, only rank 0 logs, validates and saves checkpoints
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group(backend=config['dist_backend'], rank=rank, world_size=world_size)
+    is_main = rank == 0
+
     # Define the device
     device = "cuda" if torch.cuda.is_available() else "mps" if torch.has_mps or torch.backends.mps.is_available() else "cpu"
-    print("Using device:", device)
-    if (device == 'cuda'):
-        print(f"Device name: {torch.cuda.get_device_name(device.index)}")
-        print(f"Device memory: {torch.cuda.get_device_properties(device.index).total_memory / 1024 ** 3} GB")
-    elif (device == 'mps'):
-        print(f"Device name: <mps>")
-    else:
-        print("NOTE: If you have a GPU, consider using it for training.")
-        print("      On a Windows machine with NVidia GPU, check this video: https://www.youtube.com/watch?v=GMSjDTU8Zlc")
-        print("      On a Mac machine, run: pip3 install --pre torch torchvision torchaudio torchtext --index-url https://download.pytorch.org/whl/nightly/cpu")
+    if distributed:
+        device = "cpu"
+    if is_main:
+        print("Using device:", device)
+        if distributed:
+            print(f"Distributed training on {world_size} processes ({config['dist_backend']}), {torch.get_num_threads()} threads each")
+        elif (device == 'cuda'):
+            print(f"Device name: {torch.cuda.get_device_name(device.index)}")
+            print(f"Device memory: {torch.cuda.get_device_properties(device.index).total_memory / 1024 ** 3} GB")
+        elif (device == 'mps'):
+            print(f"Device name: <mps>")
+        else:
+            print("NOTE: If you have a GPU, consider using it for training.")
+            print("      On a Windows machine with NVidia GPU, check this video: https://www.youtube.com/watch?v=GMSjDTU8Zlc")
+            print("      On a Mac machine, run: pip3 install --pre torch torchvision torchaudio torchtext --index-url https://download.pytorch.org/whl/nightly/cpu")
     device = torch.device(device)
     
     # Make sure the weights folder exists
     Path(f"{config['datasource']}_{config['model_folder']}").mkdir(parents=True, exist_ok=True)
-
-    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    checkpointer = AsyncCheckpointer(f"{config['datasource']}_{config['model_folder']}", config['model_basename'], config['keep_checkpoints'])
+
+    # the first process of every machine (LOCAL_RANK 0) builds the tokenizers and the token cache,
+    # the other processes of the machine then load them
+    local_main = int(os.environ.get('LOCAL_RANK', rank)) == 0
+    if distributed and not local_main:
+        dist.barrier()
+    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config, rank, world_size)
+    if distributed and local_main:
+        dist.barrier()
+    if distributed:
+        # the machines build their files independently, they must agree on the tokenizers, the data and the
+        # number of batches per epoch (a different count would hang in the collectives at the end of the epoch)
+        fingerprint = (hashlib.sha256((tokenizer_src.to_str() + tokenizer_tgt.to_str()).encode()).hexdigest(), len(train_dataloader.dataset), len(train_dataloader))
+        fingerprints = [None] * world_size
+        dist.all_gather_object(fingerprints, fingerprint)
+        assert all(f == fingerprints[0] for f in fingerprints), f"Tokenizers or token cache differ between the processes: {fingerprints}"
     model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
-    # Tensorboard
-    writer = SummaryWriter(config['experiment_name'])
+    # Tensorboard, the training metrics are buffered and written every metrics_flush_every iterations
+    writer = SummaryWriter(config['experiment_name']) if is_main else None
+    metrics = MetricsBuffer(writer) if is_main else None
 
     optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9)
     
@@ -206,68 +453,162 @@ def train_model(config):
     initial_epoch = 0
     global_step = 0
     preload = config['preload']
-    model_filename = latest_weights_file_path(config) if preload == 'latest' else get_weights_file_path(config, preload) if preload else None
-    if model_filename:
-        print(f'Preloading model {model_filename}')
-        state = torch.load(model_filename)
+    # only rank 0 writes checkpoints, so only its folder is read: the other processes receive the checkpoint
+    # from it, every process resumes from the same epoch without a filesystem shared between the machines
+    model_filename, state = None, None
+    if is_main:
+        model_filename = latest_weights_file_path(config) if preload == 'latest' else get_weights_file_path(config, preload) if preload else None
+        if model_filename:
+            print(f'Preloading model {model_filename}')
+            state = load_checkpoint(model_filename, map_location=device)
+        else:
+            print('No model to preload, starting from scratch')
+    if distributed:
+        received = [state]
+        dist.broadcast_object_list(received, src=0)
+        state = received[0]
+    if state is not None:
         model.load_state_dict(state['model_state_dict'])
         initial_epoch = state['epoch'] + 1
-        optimizer.load_state_dict(state['optimizer_state_dict'])
+        optimizer_state = state['optimizer_state_dict']
+        if set(state['model_state_dict']) != set(model.state_dict()):
+            # saved with the other attention layout (fused / unfused), renumber the Adam state
+            optimizer_state = remap_optimizer_state(optimizer_state, state['model_state_dict'], model)
+        if optimizer_state is not None:
+            optimizer.load_state_dict(optimizer_state)
+        elif is_main:
+            print(f'WARNING: the optimizer state of {model_filename} does not match the model, starting with a fresh optimizer')
         global_step = state['global_step']
+
+    if distributed:
+        # the initial weights are broadcast from rank 0, every backward all-reduces the gradients
+        train_model_ddp = DistributedDataParallel(model)
     else:
-        print('No model to preload, starting from scratch')
+        train_model_ddp = model
+
+    if teacher is not None:
+        # distillation (distill.py): the teacher only provides soft targets, it is never updated
+        teacher.to(device).eval().requires_grad_(False)
 
     # we dont want model ctonsider pad tokens when calculating loss, so we ignore it this way
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
+    pad_idx = tokenizer_src.token_to_id('[PAD]')
+    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_idx, label_smoothing=0.1).to(device)
+
+    # a micro-batch of batch_size sentences (or max_tokens tokens) goes through the model at once, the weights are
+    # updated every effective_batch_size sentences (tokens when max_tokens is set, the unit the sampler batches by).
+    # effective_batch_size is global: every update already averages one micro-batch per process
+    micro_batch_size = config['max_tokens'] or config['batch_size']
+    accumulation_steps = max(1, config['effective_batch_size'] // (micro_batch_size * world_size)) if config['effective_batch_size'] else 1
+
+    if config['bf16']:
+        # how much faster a training step runs with bf16 autocast than in fp32 on this machine
+        model.train()
+        speedup = measure_bf16_speedup(config, train_model_ddp, next(iter(train_dataloader)), device, loss_fn, pad_idx, tokenizer_tgt.get_vocab_size())
+        if is_main:
+            print(f"bf16 autocast training step speedup over fp32: {speedup:.2f}x")
+            writer.add_scalar('bf16 speedup', speedup, global_step)
+
+    # time spent loading data, in forward, backward and the optimizer step
+    timer = PhaseTimer(device)
+    profiler = trace_profiler(config['profile_steps'], config['experiment_name']) if is_main else None
+    if profiler is not None:
+        profiler.start()
 
     for epoch in range(initial_epoch, config['num_epochs']):
         torch.cuda.empty_cache()
         model.train()
-        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}")
-        for batch in batch_iterator:
-
-            encoder_input = batch['encoder_input'].to(device) # (batch, seq_len)
-            decoder_input = batch['decoder_input'].to(device) # (Batch, seq_len)
-            encoder_mask = batch['encoder_mask'].to(device) # (batch, 1, 1, seq_len) hide only [PAD] tokens
-            decoder_mask = batch['decoder_mask'].to(device) # (Batch, 1, seq_len, seq_len) hide [PAD] and subsequent tokens
-
-            # Run the tensors through the encoder, decoder and the projection layer
-            encoder_output = model.encode(encoder_input, encoder_mask) # (B, seq_len, d_model)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask) # (B, seq_len, d_model)
-            proj_output = model.project(decoder_output) # (B, seq_len, vocab_size)
-
-            # Compare the output with the label
-            label = batch['label'].to(device) # (Batch, seq_len)
-
-            # Compute the loss using a simple cross entropy
-            # (batch, seq_len, tgt_vocab_size) -> (batch * seq_len, tgt_vocab_size)
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
-
-            # Log the loss
-            writer.add_scalar('train loss', loss.item(), global_step)
-            writer.flush()
-
-            # Backpropagate the loss
-            loss.backward()
-
-            # Update the weights
-            optimizer.step()
-            optimizer.zero_grad(set_to_none=True)
-
-            global_step += 1
-
-        # Run validation at the end of every epoch
-        run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer)
-
-        # Save the model at the end of every epoch
-        model_filename = get_weights_file_path(config, f"{epoch:02d}")
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': global_step
-        }, model_filename)
+        # a different shuffle (and shard) every epoch
+        if isinstance(train_dataloader.sampler, DistributedSampler):
+            train_dataloader.sampler.set_epoch(epoch)
+        elif isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+            train_dataloader.batch_sampler.set_epoch(epoch)
+        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}", disable=not is_main)
+        epoch_start = time.perf_counter()
+        epoch_tokens = 0
+        window_start, window_tokens, window_samples = epoch_start, 0, 0
+        timer.reset()
+        for i, batch in enumerate(batch_iterator):
+            timer.lap('data')
+            # the gradients are only all-reduced on the micro-batch that updates the weights
+            update_step = (i + 1) % accumulation_steps == 0 or i + 1 == len(train_dataloader)
+            # the last group of the epoch can be shorter than accumulation_steps micro-batches
+            group_start = i - i % accumulation_steps
+            group_size = min(accumulation_steps, len(train_dataloader) - group_start)
+            batch_tokens = int((batch['label'] != pad_idx).sum())
+            epoch_tokens += batch_tokens
+            window_tokens += batch_tokens
+            window_samples += batch['label'].size(0)
+
+            with nullcontext() if update_step or not distributed else train_model_ddp.no_sync():
+                loss = compute_loss(config, train_model_ddp, batch, device, loss_fn, pad_idx, tokenizer_tgt.get_vocab_size(), teacher)
+                timer.lap('forward')
+                if is_main:
+                    # Log the loss, kept as a tensor until the buffer is flushed
+                    metrics.add_scalar('train loss', loss, global_step)
+
+                # Backpropagate the loss, the gradients of the group_size micro-batches of the update add up to their mean
+                (loss / group_size).backward()
+                timer.lap('backward')
+
+            # Update the weights once every accumulation_steps micro-batches (and at the end of the epoch)
+            if update_step:
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+
+                global_step += 1
+            timer.lap('optimizer')
+
+            if is_main and (i + 1) % config['metrics_flush_every'] == 0:
+                # average time per iteration of every phase and the throughput since the last flush
+                window_time = time.perf_counter() - window_start
+                for phase, seconds in timer.reset().items():
+                    metrics.add_scalar(f'time/{phase} ms', 1000 * seconds / config['metrics_flush_every'], global_step)
+                metrics.add_scalar('train tokens/sec', window_tokens / window_time, global_step)
+                metrics.add_scalar('train samples/sec', window_samples / window_time, global_step)
+                batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}", "tokens/s": f"{window_tokens / window_time:.0f}"})
+                metrics.flush()
+                window_start, window_tokens, window_samples = time.perf_counter(), 0, 0
+            if profiler is not None:
+                profiler.step()
+
+        # target tokens per second of this epoch (all processes)
+        epoch_time = time.perf_counter() - epoch_start
+        if distributed:
+            epoch_tokens_total = torch.tensor(epoch_tokens, dtype=torch.int64)
+            dist.all_reduce(epoch_tokens_total)
+            epoch_tokens = int(epoch_tokens_total)
+        tokens_per_sec = epoch_tokens / epoch_time
+
+        if is_main:
+            batch_iterator.write(f"Epoch {epoch:02d}: {epoch_time:.1f}s, {tokens_per_sec:.1f} tokens/sec{' (bf16)' if config['bf16'] else ''}")
+            metrics.add_scalar('train epoch tokens/sec', tokens_per_sec, global_step)
+            metrics.flush()
+
+            # Run validation at the end of every epoch
+            run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer, beam_size=config['beam_size'], bf16=config['bf16'])
+
+            # Save the model at the end of every epoch, written in the background while the next epoch runs
+            model_filename = get_weights_file_path(config, f"{epoch:02d}")
+            checkpointer.save({
+                'epoch': epoch,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'global_step': global_step
+            }, model_filename)
+
+        if distributed:
+            # the other processes wait for rank 0 to finish validating and saving
+            dist.barrier()
+
+    if profiler is not None:
+        profiler.stop()
+    # wait for the last checkpoint and metrics to be written
+    checkpointer.close()
+    if is_main:
+        metrics.close()
+
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
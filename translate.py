@@ -0,0 +1,152 @@
+import torch
+from pathlib import Path
+from tokenizers import Tokenizer
+
+from model import LengthMask
+from translation_cache import LRUCache
+from train import get_model, get_ds, batch_greedy_decode, beam_search_decode
+from quantize import load_quantized_model
+from shortlist import VocabShortlist
+from checkpointing import load_checkpoint
+from config import get_config, latest_weights_file_path, get_quantized_weights_file_path, get_shortlist_path
+
+class Translator:
+    # Inference entry point: loads the tokenizers and a checkpoint once,
+    # then translates batches of raw sentences with the batched decoders of train.py
+
+    def __init__(self, config, weights_file=None, device='cpu', quantized=None, model=None) -> None:
+        self.config = config
+        self.device = torch.device(device)
+        self.seq_len = config['seq_len']
+        self.beam_size = config['beam_size']
+
+        self.tokenizer_src = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_src']))))
+        self.tokenizer_tgt = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_tgt']))))
+        self.sos_idx = self.tokenizer_src.token_to_id('[SOS]')
+        self.eos_idx = self.tokenizer_src.token_to_id('[EOS]')
+        self.pad_idx = self.tokenizer_src.token_to_id('[PAD]')
+
+        # int8 mode loads the checkpoint written by quantize.py (CPU only)
+        self.quantized = config['int8_inference'] if quantized is None else quantized
+        self.model = self.load_model(weights_file, model)
+
+        # greedy decoding scores only the shortlisted target tokens (built by shortlist.py)
+        self.shortlist = VocabShortlist.load(get_shortlist_path(config)) if config['vocab_shortlist'] else None
+
+        # Repeated sentences: finished translations and (optionally) encoder outputs,
+        # keyed by the source token ids so that texts differing only in whitespace share an entry
+        mb = 1024 * 1024
+        self.translation_cache = LRUCache(config['translation_cache_mb'] * mb) if config['translation_cache_mb'] else None
+        self.encoder_cache = LRUCache(config['encoder_cache_mb'] * mb) if config['encoder_cache_mb'] else None
+
+    def load_model(self, weights_file, model):
+        # -> the model in eval mode on self.device, from weights_file (default: the latest checkpoint)
+        if weights_file is None and model is None:
+            weights_file = latest_weights_file_path(self.config)
+            if weights_file is not None and self.quantized:
+                weights_file = get_quantized_weights_file_path(self.config, weights_file)
+            if weights_file is None:
+                raise FileNotFoundError("No weights file found, train a model first")
+        self.weights_file = weights_file
+        vocab_src_len, vocab_tgt_len = self.tokenizer_src.get_vocab_size(), self.tokenizer_tgt.get_vocab_size()
+        # a given model is already loaded, e.g. the shared memory weights of an inference engine replica (engine.py)
+        if model is None and self.quantized:
+            model = load_quantized_model(self.config, weights_file, vocab_src_len, vocab_tgt_len)
+        elif model is None:
+            model = get_model(self.config, vocab_src_len, vocab_tgt_len)
+            state = load_checkpoint(weights_file)
+            model.load_state_dict(state['model_state_dict'])
+        return model.to(self.device).eval()
+
+    def tokenize(self, texts):
+        return [tuple(e.ids[:self.seq_len - 2]) for e in self.tokenizer_src.encode_batch(list(texts))]
+
+    def encode_sources(self, ids):
+        # <s> tokens </s> padded to the longest sentence of the batch (cut to seq_len)
+        max_len = max(len(x) for x in ids) + 2
+        source = torch.full((len(ids), max_len), self.pad_idx, dtype=torch.int64)
+        for i, x in enumerate(ids):
+            source[i, 0] = self.sos_idx
+            source[i, 1:len(x) + 1] = torch.tensor(x, dtype=torch.int64)
+            source[i, len(x) + 1] = self.eos_idx
+        lengths = torch.tensor([len(x) + 2 for x in ids], dtype=torch.int64)
+        return source.to(self.device), LengthMask(lengths).to(self.device)
+
+    def encode_batch(self, ids, source, source_mask):
+        # (b, seq_len, d_model) encoder output, the rows found in the encoder cache are not encoded again
+        if self.encoder_cache is None:
+            return self.model.encode(source, source_mask)
+        cached = [self.encoder_cache.get(x) for x in ids]
+        missing = [i for i, output in enumerate(cached) if output is None]
+        if missing:
+            index = torch.tensor(missing, device=self.device)
+            encoded = self.model.encode(source[index], source_mask[index])
+            for j, i in enumerate(missing):
+                # only the non [PAD] positions, they don't depend on the padding of the batch
+                cached[i] = encoded[j, :len(ids[i]) + 2].clone()
+                self.encoder_cache.put(ids[i], cached[i])
+        encoder_output = torch.zeros(source.size(0), source.size(1), self.model.src_embed.d_model, device=self.device, dtype=cached[0].dtype)
+        for i, output in enumerate(cached):
+            encoder_output[i, :output.size(0)] = output
+        return encoder_output
+
+    def decode_batch(self, source, source_mask, encoder_output=None):
+        # (b, seq_len) -> (b, max_len) token ids, everything after </s> is [PAD]
+        if self.beam_size > 1:
+            return beam_search_decode(self.model, source, source_mask, self.tokenizer_src, self.tokenizer_tgt, self.seq_len, self.device, self.beam_size, encoder_output=encoder_output)
+        vocab = self.shortlist(source) if self.shortlist is not None else None
+        return batch_greedy_decode(self.model, source, source_mask, self.tokenizer_src, self.tokenizer_tgt, self.seq_len, self.device, encoder_output=encoder_output, vocab=vocab)
+
+    @torch.inference_mode()
+    def translate_batch(self, texts):
+        if len(texts) == 0:
+            return []
+        ids = self.tokenize(texts)
+
+        # translate every distinct sentence that isn't in the translation cache once
+        translations = {}
+        for x in ids:
+            if x not in translations:
+                translations[x] = self.translation_cache.get(x) if self.translation_cache is not None else None
+        todo = [x for x, translation in translations.items() if translation is None]
+        if todo:
+            source, source_mask = self.encode_sources(todo)
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.config['bf16'] and not self.quantized):
+                encoder_output = self.encode_batch(todo, source, source_mask)
+                model_out = self.decode_batch(source, source_mask, encoder_output)
+            for x, translation in zip(todo, self.tokenizer_tgt.decode_batch(model_out.cpu().tolist())):
+                translations[x] = translation
+                if self.translation_cache is not None:
+                    self.translation_cache.put(x, translation)
+        return [translations[x] for x in ids]
+
+    def cache_stats(self):
+        return {
+            "translation_cache": self.translation_cache.stats() if self.translation_cache is not None else None,
+            "encoder_cache": self.encoder_cache.stats() if self.encoder_cache is not None else None,
+        }
+
+    def translate(self, text):
+        return self.translate_batch([text])[0]
+
+# For the latency / quality reports of the inference tools: repeated sentences would only measure the caches
+def uncached_config(config):
+    return dict(config, translation_cache_mb=0, encoder_cache_mb=0)
+
+# The first num_sentences source and target texts of the validation split
+def validation_sources(config, num_sentences: int):
+    _, val_dataloader, _, _ = get_ds(config)
+    sources, targets = [], []
+    for batch in val_dataloader:
+        sources.extend(batch['src_text'])
+        targets.extend(batch['tgt_text'])
+        if len(sources) >= num_sentences:
+            break
+    return sources[:num_sentences], targets[:num_sentences]
+
+
+if __name__ == '__main__':
+    import sys
+    translator = Translator(get_config())
+    for line in sys.stdin:
+        print(translator.translate(line.strip()))
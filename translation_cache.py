@@ -0,0 +1,58 @@
+import sys
+import torch
+from collections import OrderedDict
+
+# Size of a cached key or value in bytes, used to bound the caches by memory instead of entry count.
+# A tuple of token ids (the cache keys) holds pointers to int objects, which sys.getsizeof doesn't count
+def footprint(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(footprint(x) for x in value)
+    return sys.getsizeof(value)
+
+class LRUCache:
+    # Least recently used cache bounded by the total footprint of its keys and values (max_bytes)
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value):
+        size = footprint(key) + footprint(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }